@@ -23,6 +23,9 @@ class Settings:
     # Gemini API Configuration
     GEMINI_API_KEY: str = os.getenv("GEMINI_API_KEY", "")
     GEMINI_MODEL: str = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+    # Directory for the generated-checklist cache. Set it to share cached checklists
+    # across workers and restarts; leave empty to keep the cache in memory.
+    CHECKLIST_CACHE_DIR: str = os.getenv("CHECKLIST_CACHE_DIR", "")
 
     # Google Cloud / Firestore Configuration
     GOOGLE_CLOUD_CREDENTIALS_PATH: str = os.getenv("GOOGLE_CLOUD_CREDENTIALS_PATH", "")
@@ -31,6 +34,13 @@ class Settings:
     API_HOST: str = os.getenv("API_HOST", "0.0.0.0")
     API_PORT: int = int(os.getenv("API_PORT", "8000"))
     DEBUG: bool = os.getenv("DEBUG", "True").lower() == "true"
+    # Uvicorn worker processes (ignored when DEBUG reload is on). Upload progress and
+    # cancellation are tracked in-process, so keep 1 unless uploads are sticky-routed.
+    WORKERS: int = int(os.getenv("WORKERS", "1"))
+    # Threads available for blocking ES/Firestore/Gemini calls offloaded from handlers
+    THREAD_POOL_SIZE: int = int(os.getenv("THREAD_POOL_SIZE", "100"))
+    # Worker processes for PDF text extraction during uploads
+    PDF_WORKERS: int = int(os.getenv("PDF_WORKERS", "2"))
     
     # CORS Configuration
     
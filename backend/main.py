@@ -3,17 +3,25 @@ ProCheck Backend API
 Medical Protocol Search and Generation Service
 """
 
-from fastapi import FastAPI, HTTPException, UploadFile, File, BackgroundTasks, Form
+from fastapi import FastAPI, HTTPException, Request, UploadFile, File, BackgroundTasks, Form
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
+from pydantic import Field, StringConstraints
+from typing import Annotated, List
+import orjson
 import uvicorn
 import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import anyio.to_thread
 from config.settings import settings
 from models.protocol_models import (
     ProtocolSearchRequest,
     ProtocolSearchResponse,
-    ProtocolSearchHit,
     ProtocolGenerateRequest,
+    ProtocolTitleUpdateRequest,
     ProtocolGenerateResponse,
     StepThreadRequest,
     ChatResponse,
@@ -34,24 +42,76 @@ from services.elasticsearch_service import (
     count_documents,
     get_sample_documents,
     search_with_filters,
+    msearch_with_filters,
     hybrid_search,
 )
-from services.gemini_service import summarize_checklist, step_thread_chat, protocol_conversation_chat
+from services.gemini_service import warm_up as warm_up_gemini
+from services.gemini_service import summarize_checklist, stream_checklist, step_thread_chat, protocol_conversation_chat
 from services.firestore_service import FirestoreService
 from services.embedding_service import generate_embedding, enhance_query_with_llm
-from services.document_processor import DocumentProcessor
+from services.document_processor import DocumentProcessor, shutdown_pdf_pool
 from services.content_moderation import content_moderator
+from services.cache import TTLCache
+
+# Service modules log through the "services" logger tree; debug detail only in DEBUG
+logging.basicConfig(format="%(levelname)s:     %(name)s - %(message)s")
+logging.getLogger("services").setLevel(logging.DEBUG if settings.DEBUG else logging.INFO)
+
+# Path/query identifiers: blank or whitespace-only values are rejected by validation
+UserId = Annotated[str, StringConstraints(strip_whitespace=True, min_length=1)]
+ConversationId = Annotated[str, StringConstraints(strip_whitespace=True, min_length=1)]
+ProtocolId = Annotated[str, StringConstraints(strip_whitespace=True, min_length=1)]
+UploadId = Annotated[str, StringConstraints(strip_whitespace=True, min_length=1)]
 
 # Global document processor instance to maintain state across requests
 document_processor = DocumentProcessor()
 
+# Short-lived result caches so repeated identical queries skip the ES round-trip
+es_count_cache = TTLCache(maxsize=16, ttl=300)
+es_search_cache = TTLCache(maxsize=512, ttl=30)
+
+async def _warm_up(name: str, func) -> None:
+    """Run one blocking warm-up call; failures are logged, never fatal"""
+    try:
+        result = await asyncio.wait_for(asyncio.to_thread(func), timeout=10)
+        if isinstance(result, dict) and "error" in result:
+            print(f"⚠️  {name} warm-up failed: {result.get('details', result['error'])}")
+        else:
+            print(f"🔥 {name} connection warmed up")
+    except Exception as e:
+        print(f"⚠️  {name} warm-up failed: {e!r}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Size thread pools, pre-open backend connections; stop PDF workers on shutdown"""
+    # asyncio.to_thread uses the loop's default executor; sync routes use anyio's limiter
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=settings.THREAD_POOL_SIZE)
+    )
+    anyio.to_thread.current_default_thread_limiter().total_tokens = settings.THREAD_POOL_SIZE
+
+    # Pay client construction and TLS/DNS setup at boot, not on the first user request
+    warm_ups = [_warm_up("Firestore", FirestoreService.warm_up)]
+    if _ES_CONFIGURED:
+        warm_ups.append(_warm_up("Elasticsearch", check_cluster_health))
+    if _GEMINI_CONFIGURED:
+        warm_ups.append(_warm_up("Gemini", warm_up_gemini))
+    await asyncio.gather(*warm_ups)
+
+    yield
+    shutdown_pdf_pool()
+
 # Initialize FastAPI app
 app = FastAPI(
+    lifespan=lifespan,
     title=settings.APP_NAME,
     description=settings.APP_DESCRIPTION,
     version=settings.APP_VERSION,
-    docs_url="/docs",
-    redoc_url="/redoc"
+    # Interactive docs and the OpenAPI schema are development-only
+    docs_url="/docs" if settings.DEBUG else None,
+    redoc_url="/redoc" if settings.DEBUG else None,
+    openapi_url="/openapi.json" if settings.DEBUG else None,
+    default_response_class=ORJSONResponse
 )
 
 # CORS middleware configuration
@@ -64,76 +124,149 @@ app.add_middleware(
     expose_headers=["*"],
 )
 
+# Paths that must reach the client uncompressed. Older Starlette GZipMiddleware
+# compresses text/event-stream too, buffering SSE events until the stream ends.
+_GZIP_EXCLUDED_PATHS = frozenset({"/protocols/generate/stream"})
+
+
+class _SelectiveGZipMiddleware:
+    """GZipMiddleware that passes _GZIP_EXCLUDED_PATHS straight through"""
+
+    def __init__(self, app, minimum_size: int = 500):
+        self.app = app
+        self.gzip = GZipMiddleware(app, minimum_size=minimum_size)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in _GZIP_EXCLUDED_PATHS:
+            await self.app(scope, receive, send)
+        else:
+            await self.gzip(scope, receive, send)
+
+
+# Compress large JSON bodies (search hits, checklists); added after CORS so it wraps it
+app.add_middleware(_SelectiveGZipMiddleware, minimum_size=1024)
+
+# Settings are read from the environment once at import; resolve derived flags
+# and the static status payloads up front instead of on every request
+_ES_CONFIGURED = settings.elasticsearch_configured
+_GEMINI_CONFIGURED = settings.gemini_configured
+
+_ROOT_RESPONSE = {
+    "message": f"{settings.APP_NAME} is running!",
+    "status": "healthy",
+    "version": settings.APP_VERSION
+}
+
+_HEALTH_RESPONSE = {
+    "status": "healthy",
+    "service": settings.APP_NAME,
+    "version": settings.APP_VERSION,
+    "environment": settings.environment,
+    "config_status": {
+        "elasticsearch_configured": _ES_CONFIGURED,
+        "gemini_configured": _GEMINI_CONFIGURED
+    }
+}
+
 @app.get("/")
 async def root():
     """Root endpoint - API health check"""
-    return {
-        "message": f"{settings.APP_NAME} is running!",
-        "status": "healthy",
-        "version": settings.APP_VERSION
-    }
+    return _ROOT_RESPONSE
 
 @app.get("/health")
 async def health_check():
     """Detailed health check endpoint"""
-    return {
-        "status": "healthy",
-        "service": settings.APP_NAME,
-        "version": settings.APP_VERSION,
-        "environment": settings.environment,
-        "config_status": {
-            "elasticsearch_configured": settings.elasticsearch_configured,
-            "gemini_configured": settings.gemini_configured
-        }
-    }
+    return _HEALTH_RESPONSE
 
-@app.get("/test")
 async def test_endpoint():
     """Test endpoint for basic functionality"""
     return {
         "message": "Test endpoint working!",
         "timestamp": "2024-01-01T00:00:00Z",
         "data": {
-            "elasticsearch_configured": settings.elasticsearch_configured,
-            "gemini_configured": settings.gemini_configured,
+            "elasticsearch_configured": _ES_CONFIGURED,
+            "gemini_configured": _GEMINI_CONFIGURED,
             "elasticsearch_url": settings.ELASTICSEARCH_URL,
             "environment": settings.environment
         }
     }
 
+# Debug-only: exposes configuration details
+if settings.DEBUG:
+    app.add_api_route("/test", test_endpoint, methods=["GET"])
+
 @app.get("/elasticsearch/health")
 async def elasticsearch_health():
-    if not settings.elasticsearch_configured:
+    if not _ES_CONFIGURED:
         raise HTTPException(status_code=400, detail="Elasticsearch is not configured. Set ELASTICSEARCH_URL in env.")
-    return check_cluster_health()
+    return await asyncio.to_thread(check_cluster_health)
 
 @app.post("/elasticsearch/ensure-index")
 async def elasticsearch_ensure_index():
-    if not settings.elasticsearch_configured:
+    if not _ES_CONFIGURED:
         raise HTTPException(status_code=400, detail="Elasticsearch is not configured. Set ELASTICSEARCH_URL in env.")
-    return ensure_index()
+    return await asyncio.to_thread(ensure_index)
 
 @app.get("/elasticsearch/search")
 async def elasticsearch_search(q: str | None = None, size: int = 5):
-    if not settings.elasticsearch_configured:
+    if not _ES_CONFIGURED:
         raise HTTPException(status_code=400, detail="Elasticsearch is not configured. Set ELASTICSEARCH_URL in env.")
-    return search_protocols(q, size=size)
+    cache_key = ("search", q, size)
+    cached = es_search_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    result = await asyncio.to_thread(search_protocols, q, size=size)
+    if "error" not in result:
+        es_search_cache.set(cache_key, result)
+    return result
 
 @app.get("/elasticsearch/count")
 async def elasticsearch_count():
-    if not settings.elasticsearch_configured:
+    if not _ES_CONFIGURED:
         raise HTTPException(status_code=400, detail="Elasticsearch is not configured. Set ELASTICSEARCH_URL in env.")
-    return count_documents()
+    cached = es_count_cache.get("count")
+    if cached is not None:
+        return cached
+    result = await asyncio.to_thread(count_documents)
+    if "error" not in result:
+        es_count_cache.set("count", result)
+    return result
 
 @app.get("/elasticsearch/sample")
 async def elasticsearch_sample(size: int = 3):
-    if not settings.elasticsearch_configured:
+    if not _ES_CONFIGURED:
         raise HTTPException(status_code=400, detail="Elasticsearch is not configured. Set ELASTICSEARCH_URL in env.")
-    return get_sample_documents(size=size)
+    cache_key = ("sample", size)
+    cached = es_search_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    result = await asyncio.to_thread(get_sample_documents, size=size)
+    if "error" not in result:
+        es_search_cache.set(cache_key, result)
+    return result
+
+def _to_search_result(es_resp: dict) -> dict:
+    """Shape a raw ES search response like ProtocolSearchResponse, without model construction"""
+    hits_block = es_resp.get("hits") or {}
+    return {
+        "total": (hits_block.get("total") or {}).get("value", 0),
+        "hits": [
+            {
+                "id": h.get("_id"),
+                "score": h.get("_score"),
+                "source": h.get("_source") or {},
+                "highlight": h.get("highlight")
+            }
+            for h in hits_block.get("hits") or ()
+        ],
+        "took_ms": es_resp.get("took", 0),
+    }
 
-@app.post("/protocols/search", response_model=ProtocolSearchResponse)
+# Serialized directly with orjson; the model is only referenced for the OpenAPI schema
+@app.post("/protocols/search", responses={200: {"model": ProtocolSearchResponse}})
 async def protocols_search(
     payload: ProtocolSearchRequest,
+    request: Request,
     use_hybrid: bool = True,
     enhance_query: bool = False,
     user_id: str = None,
@@ -150,12 +283,41 @@ async def protocols_search(
         user_id: Optional Firebase Auth user ID for personalized search
         search_mode: "mixed" (user+global), "user_only", "global_only" (when user_id provided)
     """
-    if not settings.elasticsearch_configured:
+    if not _ES_CONFIGURED:
         raise HTTPException(status_code=400, detail="Elasticsearch is not configured.")
 
-    # Validate query content
-    if payload.query:
-        validation = content_moderator.validate_query(payload.query)
+    # Global searches are cached briefly; personalized results must reflect
+    # uploads/deletes immediately, so they always go to Elasticsearch.
+    # Only validated queries are ever stored, so a hit can skip moderation.
+    cache_key = None
+    if not (user_id and user_id.strip()):
+        # Key on the raw body FastAPI already read, rather than re-serializing the model
+        cache_key = ("protocols", await request.body(), use_hybrid, enhance_query)
+        cached = es_search_cache.get(cache_key)
+        if cached is not None:
+            return ORJSONResponse(cached)
+
+    original_query = payload.query
+    enhanced_info = None
+
+    # Validate query content, optionally enhancing it using Gemini
+    if original_query:
+        moderation = asyncio.to_thread(content_moderator.validate_query, original_query)
+        if enhance_query and _GEMINI_CONFIGURED:
+            # Moderation and enhancement are independent Gemini calls, so wait
+            # for the slower of the two rather than both in sequence
+            validation, enhanced_info = await asyncio.gather(
+                moderation,
+                asyncio.to_thread(enhance_query_with_llm, original_query),
+                return_exceptions=True,
+            )
+            if isinstance(validation, Exception):
+                raise validation
+            if isinstance(enhanced_info, Exception):
+                enhanced_info = None  # Silently fall back to original query
+        else:
+            validation = await moderation
+
         if not validation['valid']:
             raise HTTPException(
                 status_code=400,
@@ -166,17 +328,9 @@ async def protocols_search(
                 }
             )
 
-    original_query = payload.query
-    enhanced_info = None
-
-    # Optional: Enhance query using Gemini
-    if enhance_query and original_query and settings.gemini_configured:
-        try:
-            enhanced_info = enhance_query_with_llm(original_query)
+        if enhanced_info:
             # Use enhanced query for search
             payload.query = enhanced_info.get("enhanced_query", original_query)
-        except Exception as e:
-            pass  # Silently fall back to original query
 
     # If user_id is provided, use personalized search
     if user_id and user_id.strip():
@@ -186,7 +340,8 @@ async def protocols_search(
 
             if search_mode == "user_only":
                 # Search only user protocols
-                es_resp = search_user_protocols(
+                es_resp = await asyncio.to_thread(
+                    search_user_protocols,
                     user_id=user_id,
                     query=payload.query,
                     size=payload.size
@@ -196,7 +351,8 @@ async def protocols_search(
                 es_resp = None
             else:  # mixed mode (default)
                 # Search both user and global protocols
-                es_resp = search_mixed_protocols(
+                es_resp = await asyncio.to_thread(
+                    search_mixed_protocols,
                     user_id=user_id,
                     query=payload.query,
                     size=payload.size,
@@ -205,19 +361,7 @@ async def protocols_search(
 
             # If we got personalized results, use them
             if es_resp and not es_resp.get("error"):
-                hits = []
-                for h in es_resp.get("hits", {}).get("hits", []):
-                    hits.append(ProtocolSearchHit(
-                        id=h.get("_id"),
-                        score=h.get("_score"),
-                        source=h.get("_source", {}),
-                        highlight=h.get("highlight")
-                    ))
-
-                total = es_resp.get("hits", {}).get("total", {}).get("value", 0)
-                took = es_resp.get("took", 0)
-
-                return ProtocolSearchResponse(total=total, hits=hits, took_ms=took)
+                return ORJSONResponse(_to_search_result(es_resp))
 
         except Exception as e:
             # If personalized search fails, fall back to global search
@@ -225,13 +369,14 @@ async def protocols_search(
 
     # Global search (original logic) - used when no user_id or as fallback
     # Use hybrid search if enabled and Gemini is configured
-    if use_hybrid and settings.gemini_configured and payload.query:
+    if use_hybrid and _GEMINI_CONFIGURED and payload.query:
         try:
             # Generate query embedding for semantic search
-            query_vector = generate_embedding(payload.query, task_type="retrieval_query")
+            query_vector = await asyncio.to_thread(generate_embedding, payload.query, task_type="retrieval_query")
             
             # Perform hybrid search with RRF
-            es_resp = hybrid_search(
+            es_resp = await asyncio.to_thread(
+                hybrid_search,
                 query=payload.query,
                 query_vector=query_vector,
                 size=payload.size,
@@ -239,35 +384,61 @@ async def protocols_search(
             )
         except Exception as e:
             # Fallback to traditional search
-            es_resp = search_with_filters(payload.model_dump())
+            es_resp = await asyncio.to_thread(search_with_filters, payload.model_dump(exclude_none=True))
     else:
         # Traditional text-only search
-        es_resp = search_with_filters(payload.model_dump())
+        es_resp = await asyncio.to_thread(search_with_filters, payload.model_dump(exclude_none=True))
     
     if "error" in es_resp:
         raise HTTPException(status_code=502, detail=es_resp)
     
-    hits = []
-    for h in es_resp.get("hits", {}).get("hits", []):
-        hits.append(ProtocolSearchHit(
-            id=h.get("_id"),
-            score=h.get("_score"),
-            source=h.get("_source", {}),
-            highlight=h.get("highlight")
-        ))
-    
-    total = es_resp.get("hits", {}).get("total", {}).get("value", 0)
-    took = es_resp.get("took", 0)
-    
-    return ProtocolSearchResponse(total=total, hits=hits, took_ms=took)
+    result = _to_search_result(es_resp)
+    if cache_key is not None:
+        es_search_cache.set(cache_key, result)
+    return ORJSONResponse(result)
+
+@app.post("/protocols/search/bulk", responses={200: {"model": List[ProtocolSearchResponse]}})
+async def protocols_search_bulk(
+    payloads: Annotated[List[ProtocolSearchRequest], Field(min_length=1, max_length=20)]
+):
+    """Run several filtered text searches against the global index in one ES round-trip
+
+    Results are returned in the same order as the submitted searches.
+    """
+    if not _ES_CONFIGURED:
+        raise HTTPException(status_code=400, detail="Elasticsearch is not configured.")
+
+    # Each validation may be a Gemini call; run them side by side off the event loop
+    queries = [payload.query for payload in payloads if payload.query]
+    validations = await asyncio.gather(
+        *(asyncio.to_thread(content_moderator.validate_query, query) for query in queries)
+    )
+    for validation in validations:
+        if not validation['valid']:
+            raise HTTPException(
+                status_code=400,
+                detail={
+                    "error": "invalid_query",
+                    "message": validation['reason'],
+                    "category": validation['category']
+                }
+            )
+
+    es_resp = await asyncio.to_thread(msearch_with_filters, [p.model_dump(exclude_none=True) for p in payloads])
+    if "error" in es_resp:
+        raise HTTPException(status_code=502, detail=es_resp)
+
+    results = []
+    for resp in es_resp.get("responses", []):
+        if "error" in resp:
+            raise HTTPException(status_code=502, detail={"error": "api_error", "details": resp["error"]})
+        results.append(_to_search_result(resp))
+    return ORJSONResponse(results)
 
 @app.get("/users/{user_id}/protocols")
-async def get_user_protocols(user_id: str, size: int = 20):
+async def get_user_protocols(user_id: UserId, size: int = 20):
     """Get user's uploaded protocols from their Elasticsearch index"""
-    if not user_id or not user_id.strip():
-        raise HTTPException(status_code=400, detail="user_id is required")
-
-    if not settings.elasticsearch_configured:
+    if not _ES_CONFIGURED:
         raise HTTPException(status_code=400, detail="Elasticsearch is not configured")
 
     try:
@@ -275,14 +446,16 @@ async def get_user_protocols(user_id: str, size: int = 20):
         from services.elasticsearch_service import search_user_protocols
 
         # Get all user protocols (no specific query)
-        result = search_user_protocols(user_id=user_id, query=None, size=size)
+        result = await asyncio.to_thread(search_user_protocols, user_id=user_id, query=None, size=size)
 
         if result.get("error"):
             return {"success": False, "protocols": [], "total": 0, "error": result["error"]}
 
+        hits_block = result.get("hits") or {}
+
         # Transform ES results to a more user-friendly format
         protocols = []
-        for hit in result.get("hits", {}).get("hits", []):
+        for hit in hits_block.get("hits") or ():
             source = hit.get("_source", {})
             protocols.append({
                 "id": hit.get("_id"),
@@ -297,7 +470,7 @@ async def get_user_protocols(user_id: str, size: int = 20):
                 "protocol_data": source  # Include full data for viewing
             })
 
-        total = result.get("hits", {}).get("total", {}).get("value", 0)
+        total = (hits_block.get("total") or {}).get("value", 0)
 
         return {
             "success": True,
@@ -311,11 +484,12 @@ async def get_user_protocols(user_id: str, size: int = 20):
 
 @app.post("/protocols/generate", response_model=ProtocolGenerateResponse)
 async def protocols_generate(payload: ProtocolGenerateRequest):
-    if not settings.GEMINI_API_KEY:
+    if not _GEMINI_CONFIGURED:
         raise HTTPException(status_code=400, detail="GEMINI_API_KEY is not configured.")
 
     # Validate title and instructions
-    validation = content_moderator.validate_protocol_generation(
+    validation = await asyncio.to_thread(
+        content_moderator.validate_protocol_generation,
         payload.title,
         payload.instructions
     )
@@ -330,7 +504,7 @@ async def protocols_generate(payload: ProtocolGenerateRequest):
         )
 
     try:
-        result = summarize_checklist(
+        result = await summarize_checklist(
             title=payload.title,
             context_snippets=payload.context_snippets,
             instructions=payload.instructions,
@@ -340,27 +514,53 @@ async def protocols_generate(payload: ProtocolGenerateRequest):
     except Exception as e:
         raise HTTPException(status_code=502, detail={"error": "gemini_error", "details": str(e)})
 
-    # Preserve all fields including citation and explanation
-    checklist_items = [
-        {
-            "step": item.get("step", idx + 1), 
-            "text": item.get("text", ""),
-            "explanation": item.get("explanation", ""),  # Include explanation
-            "citation": item.get("citation", 0)  # Include citation field
-        } 
-        for idx, item in enumerate(result.get("checklist", []))
-    ]
-    return ProtocolGenerateResponse(
-        title=result.get("title", payload.title),
-        checklist=checklist_items,
-        citations=result.get("citations", []),
+    # Already shaped like ProtocolGenerateResponse, including explanation and citation
+    return result
+
+@app.post("/protocols/generate/stream")
+async def protocols_generate_stream(payload: ProtocolGenerateRequest):
+    """
+    Server-Sent Events variant of /protocols/generate.
+
+    Emits `data: {"delta": "..."}` events with raw model output as it arrives and
+    `data: {"step": {...}}` as each checklist item completes, then a final
+    `data: {"result": {...}}` event shaped like ProtocolGenerateResponse.
+    """
+    if not _GEMINI_CONFIGURED:
+        raise HTTPException(status_code=400, detail="GEMINI_API_KEY is not configured.")
+
+    validation = await asyncio.to_thread(
+        content_moderator.validate_protocol_generation,
+        payload.title,
+        payload.instructions
     )
+    if not validation['valid']:
+        raise HTTPException(
+            status_code=400,
+            detail={
+                "error": "invalid_input",
+                "message": validation['reason'],
+                "category": validation['category']
+            }
+        )
+
+    async def _stream():
+        async for event in stream_checklist(
+            title=payload.title,
+            context_snippets=payload.context_snippets,
+            instructions=payload.instructions,
+            region=payload.region,
+            year=payload.year,
+        ):
+            yield b"data: " + orjson.dumps(event) + b"\n\n"
+
+    return StreamingResponse(_stream(), media_type="text/event-stream")
 
 # Step thread chat endpoint
 @app.post("/protocols/step-thread", response_model=ChatResponse)
 async def step_thread(payload: StepThreadRequest):
     """Step-level thread chat for focused discussions"""
-    if not settings.GEMINI_API_KEY:
+    if not _GEMINI_CONFIGURED:
         raise HTTPException(status_code=400, detail="GEMINI_API_KEY is not configured.")
 
     # No content moderation for step threads - users are asking follow-up questions about existing protocols
@@ -369,7 +569,8 @@ async def step_thread(payload: StepThreadRequest):
         # Convert pydantic models to dicts for service layer
         history = [{"role": msg.role, "content": msg.content} for msg in payload.thread_history]
         
-        result = step_thread_chat(
+        result = await asyncio.to_thread(
+            step_thread_chat,
             message=payload.message,
             step_id=payload.step_id,
             step_text=payload.step_text,
@@ -379,10 +580,10 @@ async def step_thread(payload: StepThreadRequest):
             thread_history=history
         )
         
-        return ChatResponse(
-            message=result.get("message", ""),
-            updated_protocol=result.get("updated_protocol")
-        )
+        return {
+            "message": result.get("message", ""),
+            "updated_protocol": result.get("updated_protocol")
+        }
     except Exception as e:
         raise HTTPException(status_code=502, detail={"error": "thread_error", "details": str(e)})
 
@@ -390,11 +591,11 @@ async def step_thread(payload: StepThreadRequest):
 @app.post("/protocols/conversation", response_model=ProtocolConversationResponse)
 async def protocol_conversation(payload: ProtocolConversationRequest):
     """Protocol-level conversational chat for follow-up questions"""
-    if not settings.GEMINI_API_KEY:
+    if not _GEMINI_CONFIGURED:
         raise HTTPException(status_code=400, detail="GEMINI_API_KEY is not configured.")
 
     # Validate message content
-    validation = content_moderator.validate_query(payload.message)
+    validation = await asyncio.to_thread(content_moderator.validate_query, payload.message)
     if not validation['valid']:
         raise HTTPException(
             status_code=400,
@@ -409,7 +610,8 @@ async def protocol_conversation(payload: ProtocolConversationRequest):
         # Convert pydantic models to dicts for service layer
         history = [{"role": msg.role, "content": msg.content} for msg in payload.conversation_history]
         
-        result = protocol_conversation_chat(
+        result = await asyncio.to_thread(
+            protocol_conversation_chat,
             message=payload.message,
             concept_title=payload.concept_title,
             protocol_json=payload.protocol_json,
@@ -420,59 +622,48 @@ async def protocol_conversation(payload: ProtocolConversationRequest):
             user_id=payload.user_id
         )
         
-        return ProtocolConversationResponse(
-            answer=result.get("answer", ""),
-            uncertainty_note=result.get("uncertainty_note"),
-            sources=result.get("sources", []),
-            citations=result.get("citations", []),
-            used_new_sources=result.get("used_new_sources", False),
-            follow_up_questions=[
+        return {
+            "answer": result.get("answer", ""),
+            "uncertainty_note": result.get("uncertainty_note"),
+            "sources": result.get("sources", []),
+            "citations": result.get("citations", []),
+            "used_new_sources": result.get("used_new_sources", False),
+            "follow_up_questions": [
                 {"text": q["text"], "category": q.get("category")} 
                 for q in result.get("follow_up_questions", [])
             ],
-            updated_protocol=result.get("updated_protocol")
-        )
+            "updated_protocol": result.get("updated_protocol")
+        }
     except Exception as e:
         raise HTTPException(status_code=502, detail={"error": "conversation_error", "details": str(e)})
 
 # Conversation management endpoints
 @app.post("/conversations/save", response_model=ConversationResponse)
-async def save_conversation(user_id: str, payload: ConversationSaveRequest):
+async def save_conversation(user_id: UserId, payload: ConversationSaveRequest):
     """Save or update a conversation for a user"""
-    if not user_id or not user_id.strip():
-        raise HTTPException(status_code=400, detail="user_id is required")
-
-    result = FirestoreService.save_conversation(user_id, payload.model_dump())
+    result = await asyncio.to_thread(FirestoreService.save_conversation, user_id, payload.model_dump())
 
     if not result.get("success"):
         status_code = 502 if result.get("error") == "firestore_error" else 500
         raise HTTPException(status_code=status_code, detail=result)
 
-    return ConversationResponse(**result)
+    return result
 
 @app.get("/conversations/{user_id}", response_model=ConversationListResponse)
-async def get_user_conversations(user_id: str, limit: int = 20):
+async def get_user_conversations(user_id: UserId, limit: int = 20):
     """Get all conversations for a user"""
-    if not user_id or not user_id.strip():
-        raise HTTPException(status_code=400, detail="user_id is required")
-
-    result = FirestoreService.get_user_conversations(user_id, limit)
+    result = await asyncio.to_thread(FirestoreService.get_user_conversations, user_id, limit)
 
     if not result.get("success"):
         status_code = 502 if result.get("error") == "firestore_error" else 500
         raise HTTPException(status_code=status_code, detail=result)
 
-    return ConversationListResponse(**result)
+    return result
 
 @app.get("/conversations/{user_id}/{conversation_id}", response_model=ConversationDetailResponse)
-async def get_conversation(user_id: str, conversation_id: str):
+async def get_conversation(user_id: UserId, conversation_id: ConversationId):
     """Get a specific conversation for a user"""
-    if not user_id or not user_id.strip():
-        raise HTTPException(status_code=400, detail="user_id is required")
-    if not conversation_id or not conversation_id.strip():
-        raise HTTPException(status_code=400, detail="conversation_id is required")
-
-    result = FirestoreService.get_conversation(user_id, conversation_id)
+    result = await asyncio.to_thread(FirestoreService.get_conversation, user_id, conversation_id)
 
     if not result.get("success"):
         if result.get("error") == "not_found":
@@ -480,10 +671,10 @@ async def get_conversation(user_id: str, conversation_id: str):
         status_code = 502 if result.get("error") == "firestore_error" else 500
         raise HTTPException(status_code=status_code, detail=result)
 
-    return ConversationDetailResponse(**result)
+    return result
 
 @app.delete("/conversations/{user_id}/{conversation_id}")
-async def delete_conversation(user_id: str, conversation_id: str):
+async def delete_conversation(user_id: UserId, conversation_id: ConversationId):
     """Delete a conversation for a user"""
     print(f"\n{'='*80}")
     print(f"🗑️  DELETE CONVERSATION ENDPOINT CALLED")
@@ -493,15 +684,8 @@ async def delete_conversation(user_id: str, conversation_id: str):
     print(f"   - conversation_id: {conversation_id}")
     print(f"{'='*80}\n")
 
-    if not user_id or not user_id.strip():
-        print(f"❌ Validation failed: user_id is empty")
-        raise HTTPException(status_code=400, detail="user_id is required")
-    if not conversation_id or not conversation_id.strip():
-        print(f"❌ Validation failed: conversation_id is empty")
-        raise HTTPException(status_code=400, detail="conversation_id is required")
-
-    print(f"✅ Validation passed, calling FirestoreService.delete_conversation...")
-    result = FirestoreService.delete_conversation(user_id, conversation_id)
+    print(f"🔄 Calling FirestoreService.delete_conversation...")
+    result = await asyncio.to_thread(FirestoreService.delete_conversation, user_id, conversation_id)
 
     print(f"\n📊 Deletion result from FirestoreService:")
     print(f"   Result: {result}")
@@ -518,14 +702,9 @@ async def delete_conversation(user_id: str, conversation_id: str):
     return {"success": True, "message": "Conversation deleted successfully"}
 
 @app.put("/conversations/{user_id}/{conversation_id}/title")
-async def update_conversation_title(user_id: str, conversation_id: str, payload: ConversationTitleUpdateRequest):
+async def update_conversation_title(user_id: UserId, conversation_id: ConversationId, payload: ConversationTitleUpdateRequest):
     """Update conversation title"""
-    if not user_id or not user_id.strip():
-        raise HTTPException(status_code=400, detail="user_id is required")
-    if not conversation_id or not conversation_id.strip():
-        raise HTTPException(status_code=400, detail="conversation_id is required")
-
-    result = FirestoreService.update_conversation_title(user_id, conversation_id, payload.title)
+    result = await asyncio.to_thread(FirestoreService.update_conversation_title, user_id, conversation_id, payload.title)
 
     if not result.get("success"):
         if result.get("error") == "not_found":
@@ -538,12 +717,9 @@ async def update_conversation_title(user_id: str, conversation_id: str, payload:
 # ==================== Saved Protocols Endpoints ====================
 
 @app.post("/protocols/save")
-async def save_protocol_endpoint(user_id: str, protocol_data: dict):
+async def save_protocol_endpoint(user_id: UserId, protocol_data: dict):
     """Save/bookmark a protocol for a user"""
-    if not user_id or not user_id.strip():
-        raise HTTPException(status_code=400, detail="user_id is required")
-
-    result = FirestoreService.save_protocol(user_id, protocol_data)
+    result = await asyncio.to_thread(FirestoreService.save_protocol, user_id, protocol_data)
 
     if not result.get("success"):
         status_code = 502 if "firestore" in result.get("error", "") else 500
@@ -552,12 +728,9 @@ async def save_protocol_endpoint(user_id: str, protocol_data: dict):
     return result
 
 @app.get("/protocols/saved/{user_id}")
-async def get_saved_protocols_endpoint(user_id: str, limit: int = 20):
+async def get_saved_protocols_endpoint(user_id: UserId, limit: int = 20):
     """Get all saved protocols for a user"""
-    if not user_id or not user_id.strip():
-        raise HTTPException(status_code=400, detail="user_id is required")
-
-    result = FirestoreService.get_saved_protocols(user_id, limit)
+    result = await asyncio.to_thread(FirestoreService.get_saved_protocols, user_id, limit)
 
     if not result.get("success"):
         status_code = 502 if "firestore" in result.get("error", "") else 500
@@ -566,15 +739,10 @@ async def get_saved_protocols_endpoint(user_id: str, limit: int = 20):
     return result
 
 @app.delete("/protocols/saved/{user_id}/{protocol_id}")
-async def delete_saved_protocol_endpoint(user_id: str, protocol_id: str):
+async def delete_saved_protocol_endpoint(user_id: UserId, protocol_id: ProtocolId):
     """Delete a saved protocol"""
     print(f"🔥 delete_saved_protocol_endpoint called with user_id={user_id}, protocol_id={protocol_id}")
-    if not user_id or not user_id.strip():
-        raise HTTPException(status_code=400, detail="user_id is required")
-    if not protocol_id or not protocol_id.strip():
-        raise HTTPException(status_code=400, detail="protocol_id is required")
-
-    result = FirestoreService.delete_saved_protocol(user_id, protocol_id)
+    result = await asyncio.to_thread(FirestoreService.delete_saved_protocol, user_id, protocol_id)
 
     if not result.get("success"):
         if result.get("error") == "not_found":
@@ -585,14 +753,9 @@ async def delete_saved_protocol_endpoint(user_id: str, protocol_id: str):
     return result
 
 @app.get("/protocols/saved/{user_id}/{protocol_id}")
-async def get_saved_protocol_endpoint(user_id: str, protocol_id: str):
+async def get_saved_protocol_endpoint(user_id: UserId, protocol_id: ProtocolId):
     """Get a single saved protocol with full data"""
-    if not user_id or not user_id.strip():
-        raise HTTPException(status_code=400, detail="user_id is required")
-    if not protocol_id or not protocol_id.strip():
-        raise HTTPException(status_code=400, detail="protocol_id is required")
-
-    result = FirestoreService.get_saved_protocol(user_id, protocol_id)
+    result = await asyncio.to_thread(FirestoreService.get_saved_protocol, user_id, protocol_id)
 
     if not result.get("success"):
         if result.get("error") == "not_found":
@@ -603,14 +766,9 @@ async def get_saved_protocol_endpoint(user_id: str, protocol_id: str):
     return result
 
 @app.get("/protocols/saved/{user_id}/{protocol_id}/check")
-async def check_protocol_saved_endpoint(user_id: str, protocol_id: str):
+async def check_protocol_saved_endpoint(user_id: UserId, protocol_id: ProtocolId):
     """Check if a protocol is saved by the user"""
-    if not user_id or not user_id.strip():
-        raise HTTPException(status_code=400, detail="user_id is required")
-    if not protocol_id or not protocol_id.strip():
-        raise HTTPException(status_code=400, detail="protocol_id is required")
-
-    result = FirestoreService.is_protocol_saved(user_id, protocol_id)
+    result = await asyncio.to_thread(FirestoreService.is_protocol_saved, user_id, protocol_id)
 
     if not result.get("success"):
         status_code = 502 if "firestore" in result.get("error", "") else 500
@@ -619,18 +777,9 @@ async def check_protocol_saved_endpoint(user_id: str, protocol_id: str):
     return result
 
 @app.put("/protocols/saved/{user_id}/{protocol_id}/title")
-async def update_saved_protocol_title_endpoint(user_id: str, protocol_id: str, payload: dict):
+async def update_saved_protocol_title_endpoint(user_id: UserId, protocol_id: ProtocolId, payload: ProtocolTitleUpdateRequest):
     """Update the title of a saved protocol"""
-    if not user_id or not user_id.strip():
-        raise HTTPException(status_code=400, detail="user_id is required")
-    if not protocol_id or not protocol_id.strip():
-        raise HTTPException(status_code=400, detail="protocol_id is required")
-
-    new_title = payload.get("title")
-    if not new_title or not new_title.strip():
-        raise HTTPException(status_code=400, detail="title is required")
-
-    result = FirestoreService.update_saved_protocol_title(user_id, protocol_id, new_title.strip())
+    result = await asyncio.to_thread(FirestoreService.update_saved_protocol_title, user_id, protocol_id, payload.title)
 
     if not result.get("success"):
         if result.get("error") == "not_found":
@@ -642,12 +791,9 @@ async def update_saved_protocol_title_endpoint(user_id: str, protocol_id: str, p
 
 # User management endpoints
 @app.delete("/users/{user_id}")
-async def delete_user_data(user_id: str):
+async def delete_user_data(user_id: UserId):
     """Delete all user data from the backend"""
-    if not user_id or not user_id.strip():
-        raise HTTPException(status_code=400, detail="user_id is required")
-
-    result = FirestoreService.delete_user_data(user_id)
+    result = await asyncio.to_thread(FirestoreService.delete_user_data, user_id)
 
     if not result.get("success"):
         status_code = 502 if "firestore" in result.get("error", "") else 500
@@ -658,15 +804,12 @@ async def delete_user_data(user_id: str):
 # Document upload endpoints
 @app.post("/users/{user_id}/upload-documents")
 async def upload_documents(
-    user_id: str,
+    user_id: UserId,
     background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     custom_prompt: str = Form(None)
 ):
     """Upload ZIP or PDF file containing medical PDFs for protocol extraction"""
-    if not user_id or not user_id.strip():
-        raise HTTPException(status_code=400, detail="user_id is required")
-
     # Validate file type
     if not file.filename or not (file.filename.endswith('.zip') or file.filename.endswith('.pdf')):
         raise HTTPException(status_code=400, detail="Only ZIP or PDF files are allowed")
@@ -710,13 +853,8 @@ async def upload_documents(
     }
 
 @app.get("/users/{user_id}/upload-status/{upload_id}")
-async def get_upload_status(user_id: str, upload_id: str):
+async def get_upload_status(user_id: UserId, upload_id: UploadId):
     """Get status of document upload processing"""
-    if not user_id or not user_id.strip():
-        raise HTTPException(status_code=400, detail="user_id is required")
-    if not upload_id or not upload_id.strip():
-        raise HTTPException(status_code=400, detail="upload_id is required")
-
     # Check if task is still active
     upload_key = f"{user_id}_{upload_id}"
     if upload_key in document_processor.active_tasks:
@@ -744,17 +882,12 @@ async def get_upload_status(user_id: str, upload_id: str):
 
 @app.post("/users/{user_id}/protocols/{protocol_id}/regenerate")
 async def regenerate_protocol(
-    user_id: str,
-    protocol_id: str,
+    user_id: UserId,
+    protocol_id: ProtocolId,
     background_tasks: BackgroundTasks,
     custom_prompt: str = Form(None)
 ):
     """Regenerate a specific user protocol with new custom prompt"""
-    if not user_id or not user_id.strip():
-        raise HTTPException(status_code=400, detail="user_id is required")
-    if not protocol_id or not protocol_id.strip():
-        raise HTTPException(status_code=400, detail="protocol_id is required")
-
     # Initialize document processor
     # Use global processor to maintain cancellation state
 
@@ -774,12 +907,9 @@ async def regenerate_protocol(
 
 
 @app.delete("/users/{user_id}/protocols/all")
-async def delete_all_user_protocols_endpoint(user_id: str):
+async def delete_all_user_protocols_endpoint(user_id: UserId):
     """Delete all protocols for a user (both indexed protocols and preview files)"""
     print(f"🚀 delete_all_user_protocols_endpoint called for user {user_id}")
-    if not user_id or not user_id.strip():
-        raise HTTPException(status_code=400, detail="user_id is required")
-
     try:
         # Delete indexed protocols from Elasticsearch
         from services.elasticsearch_service_additions import delete_all_user_protocols as es_delete_all_protocols
@@ -804,14 +934,9 @@ async def delete_all_user_protocols_endpoint(user_id: str):
         raise HTTPException(status_code=500, detail=f"Failed to delete protocols: {str(e)}")
 
 @app.delete("/users/{user_id}/protocols/{protocol_id}")
-async def delete_user_protocol(user_id: str, protocol_id: str):
+async def delete_user_protocol(user_id: UserId, protocol_id: ProtocolId):
     """Delete a specific user-uploaded protocol"""
     print(f"🎯 delete_user_protocol endpoint called with user_id={user_id}, protocol_id={protocol_id}")
-    if not user_id or not user_id.strip():
-        raise HTTPException(status_code=400, detail="user_id is required")
-    if not protocol_id or not protocol_id.strip():
-        raise HTTPException(status_code=400, detail="protocol_id is required")
-
     try:
         print(f"🗑️ Deleting individual protocol {protocol_id} for user {user_id}")
         from services.elasticsearch_service_additions import delete_user_protocol as es_delete_protocol
@@ -834,26 +959,19 @@ async def delete_user_protocol(user_id: str, protocol_id: str):
 
 @app.put("/users/{user_id}/protocols/{protocol_id}/title")
 async def update_user_protocol_title(
-    user_id: str,
-    protocol_id: str,
-    title_update: dict  # {"title": "new title"}
+    user_id: UserId,
+    protocol_id: ProtocolId,
+    title_update: ProtocolTitleUpdateRequest
 ):
     """Update the title of a specific user-uploaded protocol"""
-    if not user_id or not user_id.strip():
-        raise HTTPException(status_code=400, detail="user_id is required")
-    if not protocol_id or not protocol_id.strip():
-        raise HTTPException(status_code=400, detail="protocol_id is required")
-
-    new_title = title_update.get('title')
-    if not new_title or not new_title.strip():
-        raise HTTPException(status_code=400, detail="title is required")
+    new_title = title_update.title
 
     try:
         # Import Elasticsearch service
         from services.elasticsearch_service_additions import update_user_protocol_title as es_update_title
 
         # Update protocol title in user's Elasticsearch index
-        updated = await es_update_title(user_id, protocol_id, new_title.strip())
+        updated = await es_update_title(user_id, protocol_id, new_title)
 
         if updated:
             return {
@@ -869,13 +987,8 @@ async def update_user_protocol_title(
 
 
 @app.get("/users/{user_id}/upload-preview/{upload_id}")
-async def get_upload_preview(user_id: str, upload_id: str):
+async def get_upload_preview(user_id: UserId, upload_id: UploadId):
     """Get preview of generated protocols before indexing"""
-    if not user_id or not user_id.strip():
-        raise HTTPException(status_code=400, detail="user_id is required")
-    if not upload_id or not upload_id.strip():
-        raise HTTPException(status_code=400, detail="upload_id is required")
-
     try:
         # Initialize document processor
         # Use global processor to maintain cancellation state
@@ -898,13 +1011,8 @@ async def get_upload_preview(user_id: str, upload_id: str):
         raise HTTPException(status_code=500, detail=f"Failed to get upload preview: {str(e)}")
 
 @app.post("/users/{user_id}/upload-approve/{upload_id}")
-async def approve_and_index_upload(user_id: str, upload_id: str, background_tasks: BackgroundTasks):
+async def approve_and_index_upload(user_id: UserId, upload_id: UploadId, background_tasks: BackgroundTasks):
     """Approve and index the generated protocols"""
-    if not user_id or not user_id.strip():
-        raise HTTPException(status_code=400, detail="user_id is required")
-    if not upload_id or not upload_id.strip():
-        raise HTTPException(status_code=400, detail="upload_id is required")
-
     try:
         # Initialize document processor
         # Use global processor to maintain cancellation state
@@ -925,17 +1033,12 @@ async def approve_and_index_upload(user_id: str, upload_id: str, background_task
 
 @app.post("/users/{user_id}/upload-regenerate/{upload_id}")
 async def regenerate_upload_protocols(
-    user_id: str,
-    upload_id: str,
+    user_id: UserId,
+    upload_id: UploadId,
     background_tasks: BackgroundTasks,
     custom_prompt: str = Form(None)
 ):
     """Regenerate protocols from an upload preview with new custom prompt"""
-    if not user_id or not user_id.strip():
-        raise HTTPException(status_code=400, detail="user_id is required")
-    if not upload_id or not upload_id.strip():
-        raise HTTPException(status_code=400, detail="upload_id is required")
-
     try:
         # Initialize document processor
         # Use global processor to maintain cancellation state
@@ -959,18 +1062,15 @@ async def regenerate_upload_protocols(
         raise HTTPException(status_code=500, detail=f"Failed to regenerating upload protocols: {str(e)}")
 
 @app.post("/users/{user_id}/upload-cancel/{upload_id}")
-async def cancel_upload(user_id: str, upload_id: str):
+async def cancel_upload(user_id: UserId, upload_id: UploadId):
     """Cancel an ongoing upload processing"""
-    if not user_id or not user_id.strip():
-        raise HTTPException(status_code=400, detail="user_id is required")
-    if not upload_id or not upload_id.strip():
-        raise HTTPException(status_code=400, detail="upload_id is required")
-
     try:
         # Initialize document processor
         # Use global processor to maintain cancellation state
 
-        # Set cancellation flag for the upload
+        # Set cancellation flag for the upload. A PDF already being extracted in the
+        # worker pool runs to completion (cancelling the awaiting task does not stop
+        # the worker process); its text is discarded and no later stage runs.
         success = await document_processor.cancel_upload(user_id, upload_id)
 
         if success:
@@ -991,13 +1091,8 @@ async def cancel_upload(user_id: str, upload_id: str):
         raise HTTPException(status_code=500, detail=f"Failed to cancel upload: {str(e)}")
 
 @app.delete("/users/{user_id}/upload-preview/{upload_id}")
-async def delete_upload_preview(user_id: str, upload_id: str):
+async def delete_upload_preview(user_id: UserId, upload_id: UploadId):
     """Delete preview file for a completed upload (Clear All functionality)"""
-    if not user_id or not user_id.strip():
-        raise HTTPException(status_code=400, detail="user_id is required")
-    if not upload_id or not upload_id.strip():
-        raise HTTPException(status_code=400, detail="upload_id is required")
-
     try:
         # Delete the preview file
         deleted = await document_processor.delete_preview_file(user_id, upload_id)
@@ -1026,5 +1121,8 @@ if __name__ == "__main__":
         "main:app",
         host=settings.API_HOST,
         port=settings.API_PORT,
-        reload=settings.DEBUG
+        reload=settings.DEBUG,
+        workers=None if settings.DEBUG else settings.WORKERS,
+        loop="uvloop",
+        http="httptools"
     )
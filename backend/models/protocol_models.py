@@ -1,5 +1,5 @@
 from typing import List, Optional, Any, Dict, Literal
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 
 class SearchFilters(BaseModel):
     region: Optional[List[str]] = None
@@ -23,6 +23,12 @@ class ProtocolSearchResponse(BaseModel):
     hits: List[ProtocolSearchHit]
     took_ms: int
 
+class ProtocolTitleUpdateRequest(BaseModel):
+    """Request model for renaming a saved or uploaded protocol"""
+    model_config = ConfigDict(extra="ignore", str_strip_whitespace=True)
+
+    title: str = Field(..., min_length=1)
+
 class ProtocolGenerateRequest(BaseModel):
     title: str
     context_snippets: List[str]
@@ -0,0 +1,80 @@
+"""
+In-process result cache for ProCheck
+Bounded LRU with per-entry expiry, shared by request handlers and services
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries expire after a time-to-live.
+
+    Safe to use from the event loop and from worker threads
+    (asyncio.to_thread), so one instance can back both.
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return the cached value for key, or None if missing or expired"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """Store value under key, evicting the least recently used entry when full"""
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class DiskTTLCache:
+    """TTLCache-compatible cache stored on disk with diskcache.
+
+    The SQLite-backed store is safe across processes, so uvicorn workers
+    sharing a directory also share entries, and entries survive restarts.
+    """
+
+    def __init__(self, directory: str, ttl: float = 60.0, size_limit: int = 1 << 30):
+        from diskcache import Cache
+
+        self.ttl = ttl
+        self._cache = Cache(directory, size_limit=size_limit)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return the cached value for key, or None if missing or expired"""
+        return self._cache.get(key)
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """Store value under key; diskcache evicts least recently stored entries past size_limit"""
+        self._cache.set(key, value, expire=self.ttl if ttl is None else ttl)
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    def __len__(self) -> int:
+        return len(self._cache)
@@ -4,8 +4,11 @@ Uses LLM to intelligently validate user input with domain-specific validation
 """
 
 import json
+import re
+import orjson
 from typing import Dict, Optional
 from config.settings import settings
+from services.cache import TTLCache
 
 # Import Gemini API
 try:
@@ -14,6 +17,49 @@ try:
 except ImportError:
     GEMINI_AVAILABLE = False
 
+# Keyword buckets for the heuristic fallback, each compiled into one alternation
+# so a query is scanned once per bucket instead of once per keyword
+_HARMFUL_KEYWORDS_RE = re.compile(
+    "|".join(['bomb', 'weapon', 'kill', 'murder', 'suicide', 'hack', 'exploit', 'poison'])
+)
+_MEDICAL_KEYWORDS_RE = re.compile("|".join([
+    'symptom', 'disease', 'treatment', 'fever', 'pain', 'doctor', 'hospital',
+    'dengue', 'malaria', 'covid', 'heart', 'stroke', 'diabetes', 'asthma'
+]))
+
+# Greeting openers, matched only as whole words at the start of the query so that
+# medical queries such as "hiv symptoms" or "hip fracture" are not mistaken for "hi"
+_GREETING_RE = re.compile(
+    r"(?:hi|hello|hey|greetings|good morning|good afternoon|good evening|hola|namaste)\b"
+)
+
+# LLM moderation verdicts keyed on the normalized (stripped, lowercased) query.
+# Popular searches repeat, and each miss costs a full Gemini round-trip.
+_moderation_cache = TTLCache(maxsize=4096, ttl=3600)
+
+_moderation_model = None
+
+
+def _get_moderation_model():
+    """Return the shared moderation model, configuring the Gemini client once.
+
+    genai.configure() drops the SDK's cached API clients, so calling it per
+    request would force a fresh connection for every Gemini call in the process.
+    """
+    global _moderation_model
+    if _moderation_model is None:
+        genai.configure(api_key=settings.GEMINI_API_KEY)
+        _moderation_model = genai.GenerativeModel(
+            model_name=settings.GEMINI_MODEL,
+            generation_config={
+                "temperature": 0.1,  # Low temperature for consistent moderation
+                "top_p": 0.95,
+                "top_k": 40,
+                "max_output_tokens": 300,
+            }
+        )
+    return _moderation_model
+
 
 class ContentModerationService:
     """Service for moderating user input content using LLM"""
@@ -104,8 +150,7 @@ Now analyze this query:"""
 
         # Check for greetings (hi, hello, hey, etc.)
         query_lower = query.strip().lower()
-        greetings = ['hi', 'hello', 'hey', 'greetings', 'good morning', 'good afternoon', 'good evening', 'hola', 'namaste']
-        if query_lower in greetings or any(query_lower.startswith(g) for g in greetings):
+        if _GREETING_RE.match(query_lower):
             return {
                 'valid': False,
                 'reason': 'Hello! Welcome to ProCheck. I\'m here to help you find medical protocols and emergency information.',
@@ -125,17 +170,12 @@ Now analyze this query:"""
 
         # Use LLM for intelligent content moderation
         if GEMINI_AVAILABLE and settings.GEMINI_API_KEY:
+            cached = _moderation_cache.get(query_lower)
+            if cached is not None:
+                return dict(cached)
+
             try:
-                genai.configure(api_key=settings.GEMINI_API_KEY)
-                model = genai.GenerativeModel(
-                    model_name=settings.GEMINI_MODEL,
-                    generation_config={
-                        "temperature": 0.1,  # Low temperature for consistent moderation
-                        "top_p": 0.95,
-                        "top_k": 40,
-                        "max_output_tokens": 300,
-                    }
-                )
+                model = _get_moderation_model()
 
                 # Create the full prompt
                 full_prompt = f"{ContentModerationService.MODERATION_SYSTEM_PROMPT}\n\nQuery: \"{query}\"\nResponse:"
@@ -151,44 +191,51 @@ Now analyze this query:"""
                 elif response_text.startswith('```'):
                     response_text = response_text.split('```')[1].split('```')[0].strip()
 
-                result = json.loads(response_text)
+                result = orjson.loads(response_text)
 
                 # Validate response structure
                 if 'valid' in result and 'category' in result:
-                    return {
+                    verdict = {
                         'valid': result.get('valid', False),
                         'reason': result.get('reason'),
                         'category': result.get('category', 'unknown'),
                         'confidence': result.get('confidence', 0.5),
                         'suggestion': result.get('suggestion')
                     }
+                    # Only LLM verdicts are cached; heuristic fallbacks are retried next time
+                    _moderation_cache.set(query_lower, verdict)
+                    return dict(verdict)
                 else:
                     # Fallback if LLM response is malformed
                     print(f"⚠️ LLM moderation returned invalid format: {response_text}")
-                    return ContentModerationService._fallback_validation(query)
+                    return ContentModerationService._fallback_validation(query_lower)
 
             except json.JSONDecodeError as e:
                 print(f"⚠️ Failed to parse LLM moderation response: {e}")
                 print(f"⚠️ Raw response: {response_text}")
-                return ContentModerationService._fallback_validation(query)
+                return ContentModerationService._fallback_validation(query_lower)
             except Exception as e:
                 print(f"⚠️ LLM moderation error: {e}")
-                return ContentModerationService._fallback_validation(query)
+                return ContentModerationService._fallback_validation(query_lower)
         else:
             # Fallback to basic validation if Gemini is not available
             print("⚠️ Gemini not available, using fallback validation")
-            return ContentModerationService._fallback_validation(query)
+            return ContentModerationService._fallback_validation(query_lower)
 
     @staticmethod
-    def _fallback_validation(query: str) -> Dict[str, any]:
+    def clear_cache() -> None:
+        """Drop all cached moderation verdicts"""
+        _moderation_cache.clear()
+
+    @staticmethod
+    def _fallback_validation(query_lower: str) -> Dict[str, any]:
         """
         Fallback validation using simple heuristics when LLM is unavailable
-        """
-        query_lower = query.lower()
 
+        Takes the stripped, lowercased query validate_query already computed.
+        """
         # Simple harmful keywords check
-        harmful_keywords = ['bomb', 'weapon', 'kill', 'murder', 'suicide', 'hack', 'exploit', 'poison']
-        if any(keyword in query_lower for keyword in harmful_keywords):
+        if _HARMFUL_KEYWORDS_RE.search(query_lower):
             return {
                 'valid': False,
                 'reason': 'This query may contain inappropriate content. Please ask a medical-related question.',
@@ -198,11 +245,7 @@ Now analyze this query:"""
             }
 
         # Simple medical keywords check
-        medical_keywords = [
-            'symptom', 'disease', 'treatment', 'fever', 'pain', 'doctor', 'hospital',
-            'dengue', 'malaria', 'covid', 'heart', 'stroke', 'diabetes', 'asthma'
-        ]
-        has_medical = any(keyword in query_lower for keyword in medical_keywords)
+        has_medical = _MEDICAL_KEYWORDS_RE.search(query_lower) is not None
 
         if not has_medical:
             return {
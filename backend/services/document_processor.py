@@ -11,7 +11,13 @@ from typing import List, Dict, Any, Optional
 from io import BytesIO
 import hashlib
 from datetime import datetime
+import orjson
 import asyncio
+import multiprocessing
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from config.settings import settings
 
 # PDF processing imports (to be installed)
 try:
@@ -28,6 +34,98 @@ except ImportError:
     PDFPLUMBER_AVAILABLE = False
     print("Warning: pdfplumber not available. Install with: pip install pdfplumber")
 
+# Concurrent Gemini calls when regenerating the protocols of one upload
+_REGENERATION_CONCURRENCY = 8
+
+# PDF text extraction is CPU-bound pure Python; run it in worker processes so it
+# neither holds the GIL nor stalls the event loop. Workers come from a fork server
+# that preloads only this module, so they don't inherit the parent's gRPC/HTTP
+# client threads. Spawn is the fallback where fork servers are unavailable (Windows).
+_pdf_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _get_pdf_pool() -> ProcessPoolExecutor:
+    global _pdf_pool
+    if _pdf_pool is None:
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload(["services.document_processor"])
+        else:
+            context = multiprocessing.get_context("spawn")
+        _pdf_pool = ProcessPoolExecutor(
+            max_workers=max(1, min(settings.PDF_WORKERS, os.cpu_count() or 1)),
+            mp_context=context,
+        )
+    return _pdf_pool
+
+
+@contextmanager
+def _hide_main_path():
+    """
+    Keep newly started workers from re-running the launching script.
+
+    multiprocessing hands every new worker the path of __main__, which the worker
+    executes as __mp_main__ before its first task. Under `python main.py` that
+    would rebuild the whole app (Firestore, ES, Gemini) in each PDF worker only to
+    run pdfplumber. _extract_pdf_text is importable from this module, so workers
+    don't need it. The pool starts workers synchronously inside submit().
+    """
+    main_module = sys.modules["__main__"]
+    main_path = getattr(main_module, "__file__", None)
+    if main_path is None:
+        yield
+        return
+    del main_module.__file__
+    try:
+        yield
+    finally:
+        main_module.__file__ = main_path
+
+
+def shutdown_pdf_pool() -> None:
+    """Stop the PDF worker processes (called on application shutdown)"""
+    global _pdf_pool
+    if _pdf_pool is not None:
+        _pdf_pool.shutdown(wait=False, cancel_futures=True)
+        _pdf_pool = None
+
+
+def _extract_pdf_text(content: bytes, filename: str) -> str:
+    """Extract text from PDF bytes using multiple methods (runs in a worker process)"""
+
+    # Method 1: Try pdfplumber (better for complex layouts)
+    if PDFPLUMBER_AVAILABLE:
+        try:
+            with pdfplumber.open(BytesIO(content)) as pdf:
+                text_parts = []
+                for page in pdf.pages:
+                    page_text = page.extract_text()
+                    if page_text:
+                        text_parts.append(page_text)
+
+                if text_parts:
+                    return "\n\n".join(text_parts)
+        except Exception as e:
+            print(f"pdfplumber failed for {filename}: {str(e)}")
+
+    # Method 2: Fallback to PyPDF2
+    if PDF_AVAILABLE:
+        try:
+            pdf_reader = PyPDF2.PdfReader(BytesIO(content))
+            text_parts = []
+
+            for page in pdf_reader.pages:
+                page_text = page.extract_text()
+                if page_text:
+                    text_parts.append(page_text)
+
+            if text_parts:
+                return "\n\n".join(text_parts)
+        except Exception as e:
+            print(f"PyPDF2 failed for {filename}: {str(e)}")
+
+    raise ValueError(f"Failed to extract text from {filename} - no PDF libraries available")
+
 
 class DocumentProcessor:
     """Handles document upload processing pipeline"""
@@ -298,48 +396,13 @@ class DocumentProcessor:
         return documents
 
     async def extract_text_from_single_pdf(self, pdf_file: Dict[str, Any]) -> str:
-        """Extract text from a single PDF file using multiple methods"""
-
-        # Method 1: Try pdfplumber (better for complex layouts)
-        if PDFPLUMBER_AVAILABLE:
-            try:
-                import pdfplumber
-                with pdfplumber.open(BytesIO(pdf_file["content"])) as pdf:
-                    text_parts = []
-                    for page in pdf.pages:
-                        # Yield to event loop to allow cancellation
-                        await asyncio.sleep(0)
-
-                        page_text = page.extract_text()
-                        if page_text:
-                            text_parts.append(page_text)
-
-                    if text_parts:
-                        return "\n\n".join(text_parts)
-            except Exception as e:
-                print(f"pdfplumber failed for {pdf_file['filename']}: {str(e)}")
-
-        # Method 2: Fallback to PyPDF2
-        if PDF_AVAILABLE:
-            try:
-                import PyPDF2
-                pdf_reader = PyPDF2.PdfReader(BytesIO(pdf_file["content"]))
-                text_parts = []
-
-                for page in pdf_reader.pages:
-                    # Yield to event loop to allow cancellation
-                    await asyncio.sleep(0)
-
-                    page_text = page.extract_text()
-                    if page_text:
-                        text_parts.append(page_text)
-
-                if text_parts:
-                    return "\n\n".join(text_parts)
-            except Exception as e:
-                print(f"PyPDF2 failed for {pdf_file['filename']}: {str(e)}")
-
-        raise ValueError(f"Failed to extract text from {pdf_file['filename']} - no PDF libraries available")
+        """Extract text from a single PDF file in the PDF worker process pool"""
+        loop = asyncio.get_running_loop()
+        with _hide_main_path():
+            future = loop.run_in_executor(
+                _get_pdf_pool(), _extract_pdf_text, pdf_file["content"], pdf_file["filename"]
+            )
+        return await future
 
     async def create_semantic_chunks(self, documents: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         """Create semantic chunks from extracted text"""
@@ -600,8 +663,7 @@ class DocumentProcessor:
             # 3. Update the existing protocol in Elasticsearch
 
             # For this MVP implementation, let's create a mock regenerated protocol
-            from datetime import datetime
-
+            timestamp = datetime.now().isoformat()
             regenerated_protocol = {
                 "protocol_id": f"regen_{protocol_id}_{regeneration_id}",
                 "title": f"Regenerated Protocol (Custom Instructions Applied)",
@@ -631,8 +693,8 @@ class DocumentProcessor:
                 "source_type": "user_regenerated",
                 "user_id": user_id,
                 "original_protocol_id": protocol_id,
-                "created_at": datetime.now().isoformat(),
-                "regenerated_at": datetime.now().isoformat(),
+                "created_at": timestamp,
+                "regenerated_at": timestamp,
                 "custom_prompt": custom_prompt,
                 "region": "User Defined",
                 "organization": "Custom Regenerated Protocol"
@@ -664,8 +726,6 @@ class DocumentProcessor:
     async def store_protocols_for_preview(self, user_id: str, upload_id: str, protocols: List[Dict[str, Any]], status: str = "completed") -> None:
         """Store generated protocols temporarily for user preview with status"""
         try:
-            import json
-
             # Create preview directory
             preview_dir = os.path.join(self.upload_dir, 'previews')
             os.makedirs(preview_dir, exist_ok=True)
@@ -680,8 +740,8 @@ class DocumentProcessor:
 
             # Store protocols as JSON file
             preview_file = os.path.join(preview_dir, f"{user_id}_{upload_id}.json")
-            with open(preview_file, 'w', encoding='utf-8') as f:
-                json.dump(preview_data, f, indent=2, ensure_ascii=False)
+            with open(preview_file, 'wb') as f:
+                f.write(orjson.dumps(preview_data, option=orjson.OPT_INDENT_2))
 
             print(f"💾 Stored {len(protocols)} protocols for preview at {preview_file} with status '{status}'")
 
@@ -692,8 +752,6 @@ class DocumentProcessor:
     async def get_preview_protocols(self, user_id: str, upload_id: str) -> Dict[str, Any]:
         """Retrieve stored protocols for preview with status"""
         try:
-            import json
-
             preview_file = os.path.join(self.upload_dir, 'previews', f"{user_id}_{upload_id}.json")
             print(f"🔍 Looking for preview file: {preview_file}")
 
@@ -712,8 +770,8 @@ class DocumentProcessor:
                 # No preview file = no protocols to show
                 return {"status": "not_found", "protocols": []}
 
-            with open(preview_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            with open(preview_file, 'rb') as f:
+                data = orjson.loads(f.read())
 
             # Handle both old format (just array) and new format (object with status)
             if isinstance(data, list):
@@ -820,7 +878,7 @@ class DocumentProcessor:
                 # Import Gemini service
                 from .gemini_service import summarize_checklist
 
-                for i, protocol in enumerate(original_protocols):
+                async def regenerate_one(i: int, protocol: Dict[str, Any]) -> Dict[str, Any]:
                     try:
                         # Extract context from original citations
                         context_snippets = []
@@ -835,11 +893,16 @@ class DocumentProcessor:
                             steps_text = ' '.join([step.get('text', '') for step in protocol.get('steps', [])])
                             context_snippets = [f"[Original Protocol] {steps_text}"]
 
+                        # Fields reused by the prompt and the regenerated record
+                        original_title = protocol.get('title', 'Medical Protocol')
+                        regenerated_title = f"Regenerated: {original_title}"
+                        region = protocol.get('region', 'User Defined')
+
                         # Create regeneration instructions
                         base_instructions = f"""
                         Regenerate this medical protocol with improved structure and content.
 
-                        Original protocol: {protocol.get('title', 'Medical Protocol')}
+                        Original protocol: {original_title}
 
                         REQUIREMENTS:
                         - Create a comprehensive, actionable medical protocol
@@ -862,33 +925,34 @@ class DocumentProcessor:
                             final_instructions = base_instructions
 
                         # Call Gemini to regenerate the protocol
-                        result = summarize_checklist(
-                            title=f"Regenerated: {protocol.get('title', 'Medical Protocol')}",
+                        result = await summarize_checklist(
+                            title=regenerated_title,
                             context_snippets=context_snippets,
                             instructions=final_instructions,
-                            region=protocol.get('region', 'User Defined'),
+                            region=region,
                             year=protocol.get('year', datetime.now().year)
                         )
 
                         # Create regenerated protocol
+                        timestamp = datetime.now().isoformat()
                         regenerated_protocol = {
                             "protocol_id": f"regen_{upload_id}_{i}_{regeneration_id}",
-                            "title": result.get("title", f"Regenerated: {protocol.get('title', 'Medical Protocol')}"),
+                            "title": result.get("title", regenerated_title),
                             "steps": result.get("checklist", []),
                             "citations": protocol.get('citations', []),  # Keep original citations
                             "source_type": "user_regenerated",
                             "user_id": user_id,
                             "original_upload_id": upload_id,
-                            "created_at": datetime.now().isoformat(),
-                            "regenerated_at": datetime.now().isoformat(),
+                            "created_at": timestamp,
+                            "regenerated_at": timestamp,
                             "custom_prompt": custom_prompt,
-                            "region": protocol.get('region', 'User Defined'),
+                            "region": region,
                             "organization": "Custom Regenerated Protocol",
                             "intent": protocol.get('intent', 'general')
                         }
 
-                        regenerated_protocols.append(regenerated_protocol)
                         print(f"✅ Regenerated protocol: {regenerated_protocol['title']}")
+                        return regenerated_protocol
 
                     except Exception as protocol_error:
                         print(f"⚠️ Failed to regenerate protocol {i}: {str(protocol_error)}")
@@ -897,7 +961,19 @@ class DocumentProcessor:
                         fallback_protocol['protocol_id'] = f"fallback_{upload_id}_{i}_{regeneration_id}"
                         fallback_protocol['title'] = f"[Fallback] {fallback_protocol.get('title', 'Medical Protocol')}"
                         fallback_protocol['regenerated_at'] = datetime.now().isoformat()
-                        regenerated_protocols.append(fallback_protocol)
+                        return fallback_protocol
+
+                # Protocols are independent, so regenerate them concurrently (bounded to
+                # stay within Gemini rate limits) instead of one round-trip after another
+                semaphore = asyncio.Semaphore(_REGENERATION_CONCURRENCY)
+
+                async def regenerate_bounded(i: int, protocol: Dict[str, Any]) -> Dict[str, Any]:
+                    async with semaphore:
+                        return await regenerate_one(i, protocol)
+
+                regenerated_protocols = list(await asyncio.gather(
+                    *(regenerate_bounded(i, protocol) for i, protocol in enumerate(original_protocols))
+                ))
 
             except ImportError:
                 print("⚠️ Gemini service not available, using enhanced mock regeneration")
@@ -929,6 +1005,8 @@ class DocumentProcessor:
     async def _generate_enhanced_mock_protocols(self, original_protocols: List[Dict[str, Any]], upload_id: str, regeneration_id: str, custom_prompt: Optional[str]) -> List[Dict[str, Any]]:
         """Generate enhanced mock protocols for regeneration when Gemini is not available"""
         enhanced_protocols = []
+        # Same for every enhanced step, so build it once
+        step_explanation = f"Regenerated with custom instructions: {custom_prompt[:100] if custom_prompt else 'Standard enhancement applied'}..."
 
         for i, protocol in enumerate(original_protocols):
             # Create enhanced version of the original protocol
@@ -940,7 +1018,7 @@ class DocumentProcessor:
                 enhanced_step = {
                     "step": j + 1,
                     "text": f"Enhanced: {step.get('text', 'Medical procedure step')}",
-                    "explanation": f"Regenerated with custom instructions: {custom_prompt[:100] if custom_prompt else 'Standard enhancement applied'}...",
+                    "explanation": step_explanation,
                     "citation": step.get('citation', 1),
                     "priority": "high" if j < 2 else "medium"
                 }
@@ -956,6 +1034,7 @@ class DocumentProcessor:
                     "priority": "medium"
                 })
 
+            timestamp = datetime.now().isoformat()
             enhanced_protocol = {
                 "protocol_id": f"enhanced_{upload_id}_{i}_{regeneration_id}",
                 "title": f"Enhanced: {protocol.get('title', 'Medical Protocol')}",
@@ -964,8 +1043,8 @@ class DocumentProcessor:
                 "source_type": "user_regenerated",
                 "user_id": protocol.get('user_id'),
                 "original_upload_id": upload_id,
-                "created_at": datetime.now().isoformat(),
-                "regenerated_at": datetime.now().isoformat(),
+                "created_at": timestamp,
+                "regenerated_at": timestamp,
                 "custom_prompt": custom_prompt,
                 "region": protocol.get('region', 'User Defined'),
                 "organization": "Enhanced Custom Protocol",
@@ -3,6 +3,10 @@ Elasticsearch service for ProCheck
 Provides connection handling and basic operations
 """
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import heapq
+import re
 from typing import Any, Dict, Optional
 from elasticsearch import Elasticsearch, ApiError
 from elasticsearch.exceptions import ConnectionError as EsConnectionError
@@ -11,6 +15,13 @@ from config.settings import settings
 
 _client: Optional[Elasticsearch] = None
 
+# Search hits never need the stored embedding (768 floats per doc); leaving it out
+# of _source keeps it off the wire from ES and out of every API response
+_HIT_SOURCE = {"excludes": ["body_embedding"]}
+
+# Worker threads for overlapping independent searches (the ES client is thread-safe)
+_search_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="es-search")
+
 
 def get_client() -> Elasticsearch:
     global _client
@@ -124,6 +135,7 @@ def search_protocols(query: Optional[str] = None, size: int = 5, index_name: Opt
             index=index,
             body={
                 "size": size,
+                "_source": _HIT_SOURCE,
                 "query": es_query,
                 "sort": [{"_score": {"order": "desc"}}],
                 "highlight": {
@@ -156,147 +168,155 @@ def get_sample_documents(size: int = 3, index_name: Optional[str] = None) -> Dic
     return search_protocols(query=None, size=size, index_name=index_name)
 
 
+# Intent keyword mapping used by _parse_medical_query
+_INTENT_PATTERNS: Dict[str, tuple] = {
+    "treatment": ("treat", "treatment", "therapy", "medication", "drug", "manage", "cure", "remedy"),
+    "symptoms": ("symptom", "sign", "presentation", "manifest", "appear", "show", "indicate"),
+    "prevention": ("prevent", "prevention", "avoid", "protect", "prophylaxis", "precaution"),
+    "diagnosis": ("diagnose", "diagnosis", "test", "screening", "detect", "identify", "assess"),
+    "complications": ("complication", "risk", "side effect", "adverse", "danger", "problem"),
+}
+_KEYWORD_TO_INTENT = {kw: intent for intent, kws in _INTENT_PATTERNS.items() for kw in kws}
+
+# One pass over the query finds every intent keyword it contains as a substring.
+# The lookahead makes matches overlap, so "treatment" and "treat" both register.
+_INTENT_KEYWORD_RE = re.compile(
+    "(?=(" + "|".join(re.escape(kw) for kw in sorted(_KEYWORD_TO_INTENT, key=len, reverse=True)) + "))"
+)
+# All keywords in one string: `word in _INTENT_KEYWORD_BLOB` is true when the word
+# is a substring of some keyword (query words never contain the newline separator)
+_INTENT_KEYWORD_BLOB = "\n".join(_KEYWORD_TO_INTENT)
+
+_QUERY_STOPWORDS = frozenset({"how", "to", "the", "a", "an", "is", "are", "what", "when", "where", "why", "do", "does", "can", "should", "during", "for", "with", "in", "on", "at", "of", "about"})
+
+
+@lru_cache(maxsize=1024)
 def _parse_medical_query(query: str) -> Dict[str, Any]:
     """
     Parse medical query to extract condition and intent keywords.
     Example: "How to treat dengue?" -> condition="dengue", intent=["treat", "treatment"]
+
+    Memoized per query string; callers must treat the returned dict as read-only.
     """
     query_lower = query.lower()
-    
-    # Intent keyword mapping
-    intent_patterns = {
-        "treatment": ["treat", "treatment", "therapy", "medication", "drug", "manage", "cure", "remedy"],
-        "symptoms": ["symptom", "sign", "presentation", "manifest", "appear", "show", "indicate"],
-        "prevention": ["prevent", "prevention", "avoid", "protect", "prophylaxis", "precaution"],
-        "diagnosis": ["diagnose", "diagnosis", "test", "screening", "detect", "identify", "assess"],
-        "complications": ["complication", "risk", "side effect", "adverse", "danger", "problem"],
-    }
-    
-    # Common medical conditions/diseases
-    # Extract potential medical terms (words that are likely disease names)
-    stopwords = {"how", "to", "the", "a", "an", "is", "are", "what", "when", "where", "why", "do", "does", "can", "should", "during", "for", "with", "in", "on", "at", "of", "about"}
-    
-    words = query_lower.split()
-    
+
     # Find intent keywords
-    intent_keywords = []
-    matched_intents = set()
-    for intent_type, keywords in intent_patterns.items():
-        for keyword in keywords:
-            if keyword in query_lower:
-                matched_intents.add(intent_type)
-                intent_keywords.append(intent_type)
-                break
+    matched_intents = {_KEYWORD_TO_INTENT[m.group(1)] for m in _INTENT_KEYWORD_RE.finditer(query_lower)}
     
     # Extract medical condition (likely to be a noun, not a stopword or intent keyword)
     condition_words = []
-    for word in words:
+    for word in query_lower.split():
         cleaned = word.strip("?.,!;:")
-        if cleaned and cleaned not in stopwords and len(cleaned) > 2:
-            # Check if it's not an intent keyword
-            is_intent = False
-            for keywords_list in intent_patterns.values():
-                if any(cleaned in kw or kw in cleaned for kw in keywords_list):
-                    is_intent = True
-                    break
-            if not is_intent:
-                condition_words.append(cleaned)
+        if cleaned and cleaned not in _QUERY_STOPWORDS and len(cleaned) > 2:
+            # Skip intent keywords: the word is part of a keyword or contains one
+            if cleaned in _INTENT_KEYWORD_BLOB or _INTENT_KEYWORD_RE.search(cleaned):
+                continue
+            condition_words.append(cleaned)
     
     # Join condition words (usually 1-2 words like "dengue", "heart attack", "type 2 diabetes")
     medical_condition = " ".join(condition_words[:3])  # Max 3 words for condition
     
     return {
         "condition": medical_condition,
-        "intent_keywords": list(matched_intents),
+        # _INTENT_PATTERNS order keeps the ES request body (and its request cache key) stable
+        "intent_keywords": [intent for intent in _INTENT_PATTERNS if intent in matched_intents],
         "raw_query": query
     }
 
 
-def search_with_filters(payload: Dict[str, Any], index_name: Optional[str] = None) -> Dict[str, Any]:
-    client = get_client()
-    index = index_name or settings.ELASTICSEARCH_INDEX_NAME
-    try:
-        query = payload.get("query")
-        size = int(payload.get("size", 10))
-        filters = payload.get("filters") or {}
+def _build_filtered_search_body(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Build the request body used by search_with_filters for one search payload"""
+    query = payload.get("query")
+    size = int(payload.get("size", 10))
+    filters = payload.get("filters") or {}
 
-        must_clause: list[Dict[str, Any]] = []
-        filter_clause: list[Dict[str, Any]] = []
-        should_clause: list[Dict[str, Any]] = []
+    must_clause: list[Dict[str, Any]] = []
+    filter_clause: list[Dict[str, Any]] = []
+    should_clause: list[Dict[str, Any]] = []
 
-        if query and str(query).strip():
-            # Parse query to extract medical condition and intent
-            parsed = _parse_medical_query(query)
-            medical_condition = parsed["condition"]
-            intent_keywords = parsed["intent_keywords"]
-            
-            # Build smart query that matches BOTH condition AND intent
-            if medical_condition:
-                # HIGH PRIORITY: Match the medical condition in disease/title/body
-                must_clause.append({
-                    "bool": {
-                        "should": [
-                            {"match": {"disease": {"query": medical_condition, "boost": 3.0}}},
-                            {"match": {"title": {"query": medical_condition, "boost": 2.5}}},
-                            {"match": {"body": {"query": medical_condition, "boost": 1.5}}}
-                        ],
-                        "minimum_should_match": 1
-                    }
-                })
-            
-            # BOOST: If intent keywords found, boost matching sections
-            if intent_keywords:
-                for intent_word in intent_keywords:
-                    should_clause.append({
-                        "match": {"section": {"query": intent_word, "boost": 3.0}}
-                    })
-                    should_clause.append({
-                        "match": {"title": {"query": intent_word, "boost": 2.0}}
-                    })
-            
-            # Fallback: general full-text search for any other query terms
-            should_clause.append({
-                "multi_match": {
-                    "query": query,
-                    "fields": ["title^2", "body", "content"],
-                    "type": "best_fields",
-                    "boost": 0.5  # Lower boost for general match
+    if query and str(query).strip():
+        # Parse query to extract medical condition and intent
+        parsed = _parse_medical_query(query)
+        medical_condition = parsed["condition"]
+        intent_keywords = parsed["intent_keywords"]
+        
+        # Build smart query that matches BOTH condition AND intent
+        if medical_condition:
+            # HIGH PRIORITY: Match the medical condition in disease/title/body
+            must_clause.append({
+                "bool": {
+                    "should": [
+                        {"match": {"disease": {"query": medical_condition, "boost": 3.0}}},
+                        {"match": {"title": {"query": medical_condition, "boost": 2.5}}},
+                        {"match": {"body": {"query": medical_condition, "boost": 1.5}}}
+                    ],
+                    "minimum_should_match": 1
                 }
             })
-        else:
-            must_clause.append({"match_all": {}})
-
-        # term filters
-        def add_terms(field: str, values: Any):
-            if isinstance(values, list) and values:
-                filter_clause.append({"terms": {field: values}})
-
-        add_terms("region", filters.get("region"))
-        add_terms("year", filters.get("year"))
-        add_terms("organization", filters.get("organization"))
-        add_terms("tags", filters.get("tags"))
-        add_terms("disease", filters.get("disease"))
+        
+        # BOOST: If intent keywords found, boost matching sections
+        if intent_keywords:
+            for intent_word in intent_keywords:
+                should_clause.append({
+                    "match": {"section": {"query": intent_word, "boost": 3.0}}
+                })
+                should_clause.append({
+                    "match": {"title": {"query": intent_word, "boost": 2.0}}
+                })
+        
+        # Fallback: general full-text search for any other query terms
+        should_clause.append({
+            "multi_match": {
+                "query": query,
+                "fields": ["title^2", "body", "content"],
+                "type": "best_fields",
+                "boost": 0.5  # Lower boost for general match
+            }
+        })
+    else:
+        must_clause.append({"match_all": {}})
+
+    # term filters
+    def add_terms(field: str, values: Any):
+        if isinstance(values, list) and values:
+            filter_clause.append({"terms": {field: values}})
+
+    add_terms("region", filters.get("region"))
+    add_terms("year", filters.get("year"))
+    add_terms("organization", filters.get("organization"))
+    add_terms("tags", filters.get("tags"))
+    add_terms("disease", filters.get("disease"))
+
+    es_query = {
+        "bool": {
+            "must": must_clause,
+            "should": should_clause,
+            "filter": filter_clause
+        }
+    }
 
-        es_query = {
-            "bool": {
-                "must": must_clause,
-                "should": should_clause,
-                "filter": filter_clause
+    return {
+        "size": size,
+        "_source": _HIT_SOURCE,
+        "query": es_query,
+        "highlight": {
+            "fields": {
+                "body": {"fragment_size": 150, "number_of_fragments": 3},
+                "content": {"fragment_size": 150, "number_of_fragments": 3}
             }
         }
+    }
+
 
+def search_with_filters(payload: Dict[str, Any], index_name: Optional[str] = None) -> Dict[str, Any]:
+    client = get_client()
+    index = index_name or settings.ELASTICSEARCH_INDEX_NAME
+    try:
+        # request_cache lets ES serve repeated identical searches from the shard cache
         resp = client.search(
             index=index,
-            body={
-                "size": size,
-                "query": es_query,
-                "highlight": {
-                    "fields": {
-                        "body": {"fragment_size": 150, "number_of_fragments": 3},
-                        "content": {"fragment_size": 150, "number_of_fragments": 3}
-                    }
-                }
-            }
+            body=_build_filtered_search_body(payload),
+            request_cache=True
         )
         return resp
     except ApiError as e:
@@ -305,13 +325,34 @@ def search_with_filters(payload: Dict[str, Any], index_name: Optional[str] = Non
         return {"error": "unexpected_error", "details": str(e)}
 
 
+def msearch_with_filters(payloads: list[Dict[str, Any]], index_name: Optional[str] = None) -> Dict[str, Any]:
+    """Run several search_with_filters queries in one _msearch round-trip
+
+    Returns the raw msearch response; "responses" is in the same order as payloads.
+    """
+    client = get_client()
+    index = index_name or settings.ELASTICSEARCH_INDEX_NAME
+    try:
+        searches: list[Dict[str, Any]] = []
+        for payload in payloads:
+            searches.append({"index": index, "request_cache": True})
+            searches.append(_build_filtered_search_body(payload))
+        resp = client.msearch(searches=searches)
+        return resp
+    except ApiError as e:
+        return {"error": "api_error", "details": str(e)}
+    except Exception as e:
+        return {"error": "unexpected_error", "details": str(e)}
+
+
 def hybrid_search(
     query: str,
     query_vector: Optional[list[float]] = None,
     size: int = 10,
     filters: Optional[Dict[str, Any]] = None,
     index_name: Optional[str] = None,
-    use_rrf: bool = False
+    use_rrf: bool = False,
+    source: Optional[Dict[str, Any]] = None
 ) -> Dict[str, Any]:
     """
     HYBRID SEARCH: Combines BM25 keyword search with vector semantic search.
@@ -326,6 +367,7 @@ def hybrid_search(
         filters: Optional filters (region, year, organization, etc.)
         index_name: Elasticsearch index name
         use_rrf: Whether to use RRF (True) or kNN approach (False, default)
+        source: Optional _source filter; defaults to everything but the embedding
     
     Returns:
         Elasticsearch response with merged results
@@ -333,6 +375,7 @@ def hybrid_search(
     client = get_client()
     index = index_name or settings.ELASTICSEARCH_INDEX_NAME
     filters = filters or {}
+    source = source or _HIT_SOURCE
     
     try:
         # Build filter clause
@@ -396,6 +439,7 @@ def hybrid_search(
                 index=index,
                 body={
                     "size": size,
+                    "_source": source,
                     "query": text_query,
                     "highlight": {
                         "fields": {
@@ -416,6 +460,7 @@ def hybrid_search(
                 index=index,
                 body={
                     "size": size,
+                    "_source": source,
                     "retriever": {
                         "rrf": {
                             "retrievers": [
@@ -512,6 +557,7 @@ def hybrid_search(
                 index=index,
                 body={
                     "size": size,
+                    "_source": source,
                     "query": {
                         "bool": {
                             "should": text_should,
@@ -687,6 +733,9 @@ def transform_protocol_to_es_doc(protocol: Dict[str, Any], user_id: str) -> Dict
     return es_doc
 
 
+_INDEX_NAME_UNSAFE_RE = re.compile(r'[^a-zA-Z0-9]')
+
+
 def get_user_index_name(user_id: str) -> str:
     """
     Generate user-specific index name
@@ -700,8 +749,7 @@ def get_user_index_name(user_id: str) -> str:
     # Clean user_id to make it safe for Elasticsearch index names
     # Index names must be lowercase, no special chars except hyphens/underscores
     # Remove any non-alphanumeric characters and convert to lowercase
-    import re
-    safe_user_id = re.sub(r'[^a-zA-Z0-9]', '', user_id.lower())
+    safe_user_id = _INDEX_NAME_UNSAFE_RE.sub('', user_id.lower())
     # Ensure it doesn't start with underscore, hyphen, or plus
     safe_user_id = safe_user_id.lstrip('_-+')
     # Limit length to avoid issues
@@ -790,9 +838,8 @@ def search_mixed_protocols(user_id: str, query: Optional[str] = None, size: int
         user_size = int(size * 0.6) if user_protocols_first else int(size * 0.4)
         global_size = size - user_size
 
-        # Search user protocols
-        user_results = search_user_protocols(user_id, query, user_size)
-        user_hits = user_results.get("hits", {}).get("hits", [])
+        # Search user protocols in the background while the global search runs
+        user_future = _search_pool.submit(search_user_protocols, user_id, query, user_size)
 
         # Search global protocols with smart query
         if query and query.strip():
@@ -841,6 +888,7 @@ def search_mixed_protocols(user_id: str, query: Optional[str] = None, size: int
             index=global_index,
             body={
                 "size": global_size,
+                "_source": _HIT_SOURCE,
                 "query": global_query,
                 "highlight": {
                     "fields": {
@@ -850,38 +898,39 @@ def search_mixed_protocols(user_id: str, query: Optional[str] = None, size: int
                 }
             }
         )
-        global_hits = global_resp.get("hits", {}).get("hits", [])
+        global_block = global_resp.get("hits") or {}
+        global_hits = global_block.get("hits") or ()
+
+        user_results = user_future.result()
+        user_block = user_results.get("hits") or {}
+        user_hits = user_block.get("hits") or ()
 
-        # Combine results and sort by relevance score for better topical matching
-        all_hits = []
+        # Combine results and sort by relevance score for better topical matching.
+        # Both responses are freshly decoded and owned by this call, so hits are
+        # annotated in place rather than copied into new dicts.
+        score_boost = 0.1 if user_protocols_first else 0
 
-        # Add user protocols with small score boost if user_protocols_first is True
+        # User protocols get a small score boost if user_protocols_first is True
         for hit in user_hits:
-            score_boost = 0.1 if user_protocols_first else 0
-            all_hits.append({
-                **hit,
-                "_score": hit.get("_score", 0) + score_boost,
-                "_source_type": "user"
-            })
+            hit["_score"] = hit.get("_score", 0) + score_boost
+            hit["_source_type"] = "user"
 
-        # Add global protocols
         for hit in global_hits:
-            all_hits.append({
-                **hit,
-                "_source_type": "global"
-            })
+            hit["_source_type"] = "global"
+
+        all_hits = [*user_hits, *global_hits]
 
-        # Sort by relevance score (highest first) for better topical coherence
-        combined_hits = sorted(all_hits, key=lambda x: x.get("_score", 0), reverse=True)
+        # Top `size` by relevance score (highest first) for better topical coherence
+        combined_hits = heapq.nlargest(size, all_hits, key=lambda x: x.get("_score", 0))
 
         # Create combined response
-        total_user = user_results.get("hits", {}).get("total", {}).get("value", 0)
-        total_global = global_resp.get("hits", {}).get("total", {}).get("value", 0)
+        total_user = (user_block.get("total") or {}).get("value", 0)
+        total_global = (global_block.get("total") or {}).get("value", 0)
 
         combined_response = {
             "hits": {
                 "total": {"value": total_user + total_global},
-                "hits": combined_hits[:size]  # Limit to requested size
+                "hits": combined_hits
             },
             "user_protocols_count": total_user,
             "global_protocols_count": total_global
@@ -3,18 +3,22 @@ Embedding service using Google Gemini
 Generates embeddings for hybrid search in Elasticsearch
 """
 
-from typing import List, Optional
-import google.generativeai as genai
+from typing import Any, List, Optional
+import orjson
 from config.settings import settings
 
+# Imported on first use, like in gemini_service
+genai: Any = None
 _embedding_initialized = False
+_enhance_model = None
 
 def _ensure_embedding_client():
-    global _embedding_initialized
+    global _embedding_initialized, genai
     if _embedding_initialized:
         return
     if not settings.GEMINI_API_KEY:
         raise RuntimeError("GEMINI_API_KEY is not configured")
+    import google.generativeai as genai
     genai.configure(api_key=settings.GEMINI_API_KEY)
     _embedding_initialized = True
 
@@ -69,6 +73,20 @@ def generate_embeddings_batch(texts: List[str], task_type: str = "retrieval_docu
     return embeddings
 
 
+def _get_enhance_model():
+    """Reuse one model instance so its API client and connections persist"""
+    global _enhance_model
+    if _enhance_model is None:
+        _enhance_model = genai.GenerativeModel(
+            model_name="gemini-2.0-flash-exp",
+            generation_config={
+                "temperature": 0.1,
+                "max_output_tokens": 256,
+            },
+        )
+    return _enhance_model
+
+
 def enhance_query_with_llm(query: str) -> dict:
     """
     Enhance user query using Gemini for better search results.
@@ -83,13 +101,7 @@ def enhance_query_with_llm(query: str) -> dict:
     _ensure_embedding_client()
     
     try:
-        model = genai.GenerativeModel(
-            model_name="gemini-2.0-flash-exp",
-            generation_config={
-                "temperature": 0.1,
-                "max_output_tokens": 256,
-            },
-        )
+        model = _get_enhance_model()
         
         prompt = f"""You are a medical search assistant. Analyze this query and enhance it for better search.
 
@@ -112,9 +124,8 @@ Output ONLY valid JSON, no markdown or explanation."""
 
         response = model.generate_content(prompt)
         
-        import json
         try:
-            result = json.loads(response.text)
+            result = orjson.loads(response.text)
             return result
         except:
             # Fallback: return original query
@@ -7,6 +7,7 @@ from typing import Dict, List, Any, Optional
 from datetime import datetime, timedelta
 import os
 import hashlib
+import heapq
 import json
 import firebase_admin
 from firebase_admin import credentials, firestore
@@ -88,6 +89,12 @@ class FirestoreService:
         except Exception as e:
             raise Exception(f"Firestore client not initialized. Check your GCP credentials. Error: {e}")
 
+    @staticmethod
+    def warm_up() -> None:
+        """Initialize the client and open its channel with one cheap document read"""
+        db = FirestoreService._get_db()
+        db.collection(FirestoreService.USER_INDEX_COLLECTION).document("_warmup").get()
+
     @staticmethod
     def _generate_content_hash(messages: List[Dict[str, Any]]) -> str:
         """
@@ -156,23 +163,30 @@ class FirestoreService:
                     
                     # Check if conversation was created within last 5 minutes
                     if time_diff < 300:  # 5 minutes
-                        # Get the actual conversation to check content hash
-                        doc_id = conv.get('document_id')
-                        if doc_id:
+                        # Index entries carry the content hash and message count, so
+                        # only older entries without them need the conversation document
+                        existing_hash = conv.get('content_hash')
+                        existing_count = conv.get('message_count')
+                        if existing_hash is None or existing_count is None:
+                            doc_id = conv.get('document_id')
+                            if not doc_id:
+                                continue
                             doc_ref = db.collection(FirestoreService.CONVERSATIONS_COLLECTION).document(doc_id)
-                            doc = doc_ref.get()
-                            if doc.exists:
-                                existing_messages = doc.to_dict().get('messages', [])
-                                existing_hash = FirestoreService._generate_content_hash(existing_messages)
-                                
-                                # If hashes match and message counts are similar, it's a duplicate
-                                if existing_hash == content_hash and abs(len(existing_messages) - len(messages)) <= 2:
-                                    duplicate_found = True
-                                    existing_conv_id = conv.get('conversation_id')
-                                    print(f"🔍 Duplicate conversation detected: {existing_conv_id}")
-                                    print(f"   Content hash: {content_hash}")
-                                    print(f"   Time difference: {time_diff:.1f}s")
-                                    break
+                            doc = doc_ref.get(field_paths=['messages'])
+                            if not doc.exists:
+                                continue
+                            existing_messages = doc.to_dict().get('messages', [])
+                            existing_hash = FirestoreService._generate_content_hash(existing_messages)
+                            existing_count = len(existing_messages)
+
+                        # If hashes match and message counts are similar, it's a duplicate
+                        if existing_hash == content_hash and abs(existing_count - len(messages)) <= 2:
+                            duplicate_found = True
+                            existing_conv_id = conv.get('conversation_id')
+                            print(f"🔍 Duplicate conversation detected: {existing_conv_id}")
+                            print(f"   Content hash: {content_hash}")
+                            print(f"   Time difference: {time_diff:.1f}s")
+                            break
                 except (ValueError, AttributeError) as e:
                     # Skip if timestamp parsing fails
                     continue
@@ -265,11 +279,8 @@ class FirestoreService:
 
             conversations_list = user_index_data.to_dict().get('conversations', [])
 
-            # Sort by updated_at descending
-            conversations_list.sort(key=lambda x: x.get("updated_at", ""), reverse=True)
-
-            # Limit results
-            conversations = conversations_list[:limit]
+            # Most recently updated first; only the top `limit` entries are ordered
+            conversations = heapq.nlargest(limit, conversations_list, key=lambda x: x.get("updated_at", ""))
 
             # Format for response (remove document_id)
             formatted_conversations = []
@@ -590,11 +601,8 @@ class FirestoreService:
 
             protocols_list = user_protocols_index_data.to_dict().get('protocols', [])
 
-            # Sort by saved_at descending
-            protocols_list.sort(key=lambda x: x.get("saved_at", ""), reverse=True)
-
-            # Limit results
-            protocols = protocols_list[:limit]
+            # Most recently saved first; only the top `limit` entries are ordered
+            protocols = heapq.nlargest(limit, protocols_list, key=lambda x: x.get("saved_at", ""))
 
             # Return only metadata from index (no full protocol data fetch)
             # This reduces from N+1 reads to just 1 read
@@ -676,8 +684,8 @@ class FirestoreService:
             doc_id = f"{user_id}_{protocol_id}"
             doc_ref = db.collection(FirestoreService.SAVED_PROTOCOLS_COLLECTION).document(doc_id)
 
-            # Check if exists
-            if not doc_ref.get().exists:
+            # Check if exists (empty field mask: no document data is transferred)
+            if not doc_ref.get(field_paths=[]).exists:
                 return {"success": False, "error": "not_found", "details": "Protocol not found"}
 
             # Delete the protocol document
@@ -717,7 +725,7 @@ class FirestoreService:
 
             return {
                 "success": True,
-                "is_saved": doc_ref.get().exists
+                "is_saved": doc_ref.get(field_paths=[]).exists
             }
 
         except Exception as e:
@@ -742,9 +750,8 @@ class FirestoreService:
             doc_id = f"{user_id}_{protocol_id}"
             doc_ref = db.collection(FirestoreService.SAVED_PROTOCOLS_COLLECTION).document(doc_id)
 
-            # Check if exists
-            doc = doc_ref.get()
-            if not doc.exists:
+            # Check if exists (empty field mask: no document data is transferred)
+            if not doc_ref.get(field_paths=[]).exists:
                 return {"success": False, "error": "not_found", "details": "Protocol not found"}
 
             # Update the protocol document
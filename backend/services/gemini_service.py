@@ -1,17 +1,51 @@
-from typing import List, Dict, Any, Optional
+from typing import AsyncIterator, List, Dict, Any, Optional, Set, Tuple
+import asyncio
+import copy
+import json
+import logging
+import math
+import operator
 import re
-import google.generativeai as genai
+import traceback
+from functools import lru_cache
+import orjson
 from config.settings import settings
+from services.cache import DiskTTLCache, TTLCache
+from services.elasticsearch_service import hybrid_search
+from services.embedding_service import generate_embedding
 
+logger = logging.getLogger(__name__)
+
+# google.generativeai pulls in grpc and takes about half a second to import, so it
+# is loaded on first use; scripts that only need the parsers never pay for it
+genai: Any = None
 _client_initialized = False
 _model: Any | None = None
 
+# Generated checklists keyed on everything that goes into the prompt. Repeated
+# searches for the same protocol would otherwise pay a full Gemini round-trip.
+if settings.CHECKLIST_CACHE_DIR:
+    _checklist_cache = DiskTTLCache(settings.CHECKLIST_CACHE_DIR, ttl=3600)
+else:
+    _checklist_cache = TTLCache(maxsize=1000, ttl=3600)
+
+# Paraphrased titles ("dengue management" / "dengue treatment protocol") miss the
+# exact cache. Entries are grouped by the remaining prompt inputs and the intent
+# template, so a title is only ever compared against checklists built from the
+# very same prompt template and sources.
+_semantic_checklist_cache = TTLCache(maxsize=1000, ttl=3600)
+_SEMANTIC_CACHE_THRESHOLD = 0.92
+_SEMANTIC_CACHE_PER_SOURCES = 8
+# Pending background stores; asyncio only holds weak references to tasks
+_semantic_store_tasks: Set[asyncio.Task] = set()
+
 def _ensure_client():
-    global _client_initialized, _model
+    global _client_initialized, _model, genai
     if _client_initialized and _model is not None:
         return
     if not settings.GEMINI_API_KEY:
         raise RuntimeError("GEMINI_API_KEY is not configured")
+    import google.generativeai as genai
     genai.configure(api_key=settings.GEMINI_API_KEY)
     _model = genai.GenerativeModel(
         model_name=settings.GEMINI_MODEL,
@@ -25,6 +59,13 @@ def _ensure_client():
     _client_initialized = True
 
 
+def warm_up() -> None:
+    """Create the model and open its API connection before the first request"""
+    _ensure_client()
+    assert _model is not None
+    _model.count_tokens("ping")
+
+
 def _extract_text(response: Any) -> str:
     # Try the quick accessor, then fall back to candidates->parts
     try:
@@ -63,25 +104,25 @@ def _validate_protocol_response(data: Dict[str, Any]) -> tuple[bool, str]:
     if not checklist:
         return False, "Checklist is empty"
     
+    # Cheapest rejection first: no need to walk the steps without citations
     citations = data.get("citations", [])
+    if not citations:
+        return False, "Citations array is empty"
     
-    # Count incomplete steps
-    incomplete_steps = 0
+    # Count incomplete steps in a single pass
     missing_explanations = 0
     missing_citations = 0
     
     for item in checklist:
         if not isinstance(item, dict):
-            incomplete_steps += 1
             continue
         
         explanation = item.get("explanation", "").strip()
-        citation = item.get("citation", 0)
         
-        if not explanation or len(explanation) < 10:
+        if len(explanation) < 10:
             missing_explanations += 1
         
-        if citation == 0:
+        if item.get("citation", 0) == 0:
             missing_citations += 1
     
     total_steps = len(checklist)
@@ -93,13 +134,34 @@ def _validate_protocol_response(data: Dict[str, Any]) -> tuple[bool, str]:
     if missing_citations > total_steps * 0.5:
         return False, f"{missing_citations}/{total_steps} steps missing citations"
     
-    # Check if citations array is empty
-    if not citations or len(citations) == 0:
-        return False, "Citations array is empty"
-    
     return True, ""
 
 
+# Prefixes/endings that make a step verbose. Alternation order matches the
+# original lists, so the first listed match still wins.
+_STEP_PREFIXES = (
+    "Step", "Action", "Task", "Procedure", "Process", "Check", "Verify", "Ensure", "Confirm",
+    "The patient should", "The healthcare provider should", "The clinician should",
+    "It is important to", "It is recommended to", "It is necessary to",
+    "First", "Next", "Then", "Finally", "Additionally", "Furthermore",
+)
+_STEP_ENDINGS = (
+    "as needed", "if necessary", "if required", "if appropriate", "if indicated",
+    "according to protocol", "per guidelines", "as per standard practice",
+    "to ensure patient safety", "for optimal outcomes", "for best results",
+)
+# [Source N] tags and (disease): prefixes, removed anywhere in one pass. The
+# prefix branch also spans tags inside the parentheses, which a separate
+# tag-stripping pass would have removed first.
+_STEP_TAGS_RE = re.compile(r'\[Source\s+\d+\]\s*|\((?:[a-zA-Z\s]|\[Source\s+\d+\])+\):\s*')
+_STEP_PREFIX_RE = re.compile(
+    r'^(?:' + '|'.join(map(re.escape, _STEP_PREFIXES)) + r')\s*(?::\s*)?', re.IGNORECASE
+)
+_STEP_ENDING_RE = re.compile(
+    r'\s*(?:' + '|'.join(map(re.escape, _STEP_ENDINGS)) + r')\Z', re.IGNORECASE
+)
+
+
 def _clean_checklist_step(text: str) -> str:
     """Clean and shorten a checklist step to be concise and actionable."""
     text = str(text).strip()
@@ -107,45 +169,29 @@ def _clean_checklist_step(text: str) -> str:
         return ""
     
     # Remove [Source N] tags and (disease): prefixes
-    text = re.sub(r'\[Source\s+\d+\]\s*', '', text)
-    text = re.sub(r'\([a-zA-Z\s]+\):\s*', '', text)
-    
-    # Remove leading numbers like "1.", "2)", "3 -", etc.
-    text = re.sub(r'^[\d\-\.\)]+\s*', '', text.strip())
+    text = _STEP_TAGS_RE.sub('', text)
     
-    # Remove common prefixes that make it verbose
-    prefixes_to_remove = [
-        "Step", "Action", "Task", "Procedure", "Process", "Check", "Verify", "Ensure", "Confirm",
-        "The patient should", "The healthcare provider should", "The clinician should",
-        "It is important to", "It is recommended to", "It is necessary to",
-        "First", "Next", "Then", "Finally", "Additionally", "Furthermore",
-    ]
+    # Remove leading numbers like "1.", "2)", "3 -", etc. Usually there are none
+    # or only a few characters, so a plain scan beats starting the regex engine
+    text = text.strip()
+    end = 0
+    while end < len(text) and (text[end] in "-.)" or text[end].isdecimal()):
+        end += 1
+    if end:
+        text = text[end:].lstrip()
     
-    for prefix in prefixes_to_remove:
-        if text.lower().startswith(prefix.lower()):
-            text = text[len(prefix):].strip()
-            if text.startswith(":"):
-                text = text[1:].strip()
-            break
-    
-    # Remove verbose endings
-    endings_to_remove = [
-        "as needed", "if necessary", "if required", "if appropriate", "if indicated",
-        "according to protocol", "per guidelines", "as per standard practice",
-        "to ensure patient safety", "for optimal outcomes", "for best results",
-    ]
-    
-    for ending in endings_to_remove:
-        if text.lower().endswith(ending.lower()):
-            text = text[:-len(ending)].strip()
-            break
+    # Remove common prefixes that make it verbose, then verbose endings
+    text = _STEP_PREFIX_RE.sub('', text, count=1)
+    text = _STEP_ENDING_RE.sub('', text, count=1)
     
     # Limit length to keep it concise
     if len(text) > 120:
-        # Try to cut at a natural break
-        for delimiter in [". ", "; ", ", "]:
-            if delimiter in text[:120]:
-                text = text[:text[:120].rfind(delimiter) + 1].strip()
+        # Try to cut at a natural break, preferring sentence ends over clauses
+        window = text[:120]
+        for delimiter in (". ", "; ", ", "):
+            cut = window.rfind(delimiter)
+            if cut >= 0:
+                text = window[:cut + 1].strip()
                 break
         else:
             text = text[:117] + "..."
@@ -153,95 +199,367 @@ def _clean_checklist_step(text: str) -> str:
     return text
 
 
+# Checked in order, so e.g. "severe dengue treatment" is still an emergency
+_QUERY_INTENT_KEYWORDS = (
+    ('emergency', ('emergency', 'urgent', 'attack', 'crisis', 'acute', 'severe', 'critical')),
+    ('treatment', ('treatment', 'manage', 'therapy', 'medication', 'drug', 'protocol')),
+    ('diagnosis', ('diagnosis', 'diagnose', 'differential', 'test', 'screening')),
+    ('symptoms', ('symptom', 'sign', 'presentation', 'manifestation')),
+    ('prevention', ('prevention', 'prevent', 'avoid', 'protect', 'prophylaxis')),
+)
+_QUERY_INTENT_RES = tuple(
+    (intent, re.compile('|'.join(keywords))) for intent, keywords in _QUERY_INTENT_KEYWORDS
+)
+
+
+@lru_cache(maxsize=1024)
 def classify_query_intent(title: str) -> str:
     """Classify the query type to choose appropriate template"""
     title_lower = title.lower()
-    
-    # Emergency keywords
-    if any(word in title_lower for word in ['emergency', 'urgent', 'attack', 'crisis', 'acute', 'severe', 'critical']):
-        return 'emergency'
-    
-    # Treatment keywords
-    if any(word in title_lower for word in ['treatment', 'manage', 'therapy', 'medication', 'drug', 'protocol']):
-        return 'treatment'
-    
-    # Diagnosis keywords
-    if any(word in title_lower for word in ['diagnosis', 'diagnose', 'differential', 'test', 'screening']):
-        return 'diagnosis'
-    
-    # Symptoms keywords
-    if any(word in title_lower for word in ['symptom', 'sign', 'presentation', 'manifestation']):
-        return 'symptoms'
-    
-    # Prevention keywords
-    if any(word in title_lower for word in ['prevention', 'prevent', 'avoid', 'protect', 'prophylaxis']):
-        return 'prevention'
-    
+    for intent, pattern in _QUERY_INTENT_RES:
+        if pattern.search(title_lower):
+            return intent
     return 'general'
 
 
-def summarize_checklist(title: str, context_snippets: List[str], instructions: str | None = None, region: str | None = None, year: int | None = None) -> Dict[str, Any]:
-    _ensure_client()
-    assert _model is not None
+# Everything that does not depend on the request comes first, so repeated
+# generations share an identical prompt prefix that Gemini can cache implicitly.
+_CHECKLIST_PROMPT_HEAD = "\n".join([
+    # Concise instructions - STRICT SOURCE-BASED GENERATION
+    "Extract a medical protocol from the provided sources. Use ONLY information in the [Source N] snippets.",
+    "",
+    "⚠️ CRITICAL RULES:",
+    "1. ONLY use information EXPLICITLY in sources below",
+    "2. EVERY step needs: 'text' (action), 'explanation' (2-3 sentences), 'citation' (1-6)",
+    "3. NO empty explanations, NO citation=0, NO made-up content",
+    "",
+    "OUTPUT FORMAT (JSON only, no markdown):",
+    '{"title": "X", "checklist": [{"step": 1, "text": "Brief action", "explanation": "Detailed how-to from source", "citation": 1}], "citations": ["Source 1 text", "Source 2 text"]}',
+    "",
+    "EXAMPLE STEP:",
+    '{"step": 1, "text": "Monitor fever and headache", "explanation": "Check temperature regularly. Dengue causes high fever (39-40°C) with severe frontal headache. Document patterns.", "citation": 1}',
+    "",
+    "⛔ FILTERS:",
+    "- Skip sources about DIFFERENT conditions",
+    "- Only info DIRECTLY related to the QUERY below",
+    "- 3-4 accurate steps better than 10 with made-up content",
+])
+
+# Intent-specific templates (concise)
+_INTENT_HINTS = {
+    'emergency': "Start with immediate actions (call 911, etc.). Keep steps urgent and short.",
+    'symptoms': "List symptoms chronologically. Include severity levels and when to seek help.",
+    'treatment': "Start with first-line treatments. Include specific dosages/instructions.",
+    'diagnosis': "Clinical assessment → diagnostic tests → criteria. Be specific.",
+    'prevention': "Primary prevention first. Practical, actionable steps.",
+    'general': "Logical flow: assessment → intervention → follow-up. Stay concise."
+}
+# Full static part of the prompt for each intent, built once
+_INTENT_PROMPT_HEADS = {
+    intent: f"{_CHECKLIST_PROMPT_HEAD}\n\nHINT: {hint}\n\n" for intent, hint in _INTENT_HINTS.items()
+}
+
+
+_MAX_PROMPT_SNIPPETS = 6
+_MAX_SNIPPET_CHARS = 1500
+# Word-set overlap above which a snippet is treated as a repeat of an earlier one
+_DUPLICATE_SNIPPET_JACCARD = 0.8
+_SNIPPET_SOURCE_TAG_RE = re.compile(r"\[source\s+\d+\]")
+_SNIPPET_WORD_RE = re.compile(r"[a-z0-9]+")
+
+
+def _select_snippets(context_snippets: List[str]) -> List[tuple[int, str]]:
+    """
+    Number the snippets that go into the prompt, skipping near-duplicates and
+    capping their length. Kept snippets keep their original source number,
+    since the frontend maps step citations back to its own source list.
+    """
+    selected: List[tuple[int, str]] = []
+    seen_words: List[frozenset] = []
+    for i, snippet in enumerate(context_snippets[:_MAX_PROMPT_SNIPPETS], 1):
+        # Ignore [Source N] tags and punctuation, but keep numbers: doses must not collapse
+        words = frozenset(_SNIPPET_WORD_RE.findall(_SNIPPET_SOURCE_TAG_RE.sub(" ", snippet.lower())))
+        if not words:
+            continue
+        if any(len(words & other) >= _DUPLICATE_SNIPPET_JACCARD * len(words | other) for other in seen_words):
+            continue
+        seen_words.append(words)
+        if len(snippet) > _MAX_SNIPPET_CHARS:
+            snippet = snippet[:_MAX_SNIPPET_CHARS] + "..."
+        selected.append((i, snippet))
+    return selected
+
 
+def _build_checklist_prompt(title: str, context_snippets: List[str], instructions: str | None = None, region: str | None = None, year: int | None = None) -> str:
     # Classify query intent for smart templating
-    intent = classify_query_intent(title)
+    head = _INTENT_PROMPT_HEADS.get(classify_query_intent(title), _INTENT_PROMPT_HEADS['general'])
     
-    # Concise instructions - STRICT SOURCE-BASED GENERATION
-    base_instructions = [
-        "Extract a medical protocol from the provided sources. Use ONLY information in the [Source N] snippets.",
-        "",
-        "⚠️ CRITICAL RULES:",
-        "1. ONLY use information EXPLICITLY in sources below",
-        "2. EVERY step needs: 'text' (action), 'explanation' (2-3 sentences), 'citation' (1-6)",
-        "3. NO empty explanations, NO citation=0, NO made-up content",
-        "",
-        "OUTPUT FORMAT (JSON only, no markdown):",
-        '{"title": "X", "checklist": [{"step": 1, "text": "Brief action", "explanation": "Detailed how-to from source", "citation": 1}], "citations": ["Source 1 text", "Source 2 text"]}',
-        "",
-        "EXAMPLE STEP:",
-        '{"step": 1, "text": "Monitor fever and headache", "explanation": "Check temperature regularly. Dengue causes high fever (39-40°C) with severe frontal headache. Document patterns.", "citation": 1}',
-    ]
+    # Only the request-specific tail is formatted per call
+    details = ""
+    if region:
+        details += f"\nRegion: {region}"
+    if year:
+        details += f"\nYear: {year}"
+    if instructions:
+        details += f"\nNote: {instructions}"
+    sources = "".join(f"\n[Source {i}] {snippet}\n" for i, snippet in _select_snippets(context_snippets))
+
+    return (
+        f"{head}━━━ QUERY: {title}{details}\n\n"
+        f"━━━ SOURCES (cite as [Source N]):{sources}"
+    )
+
+
+_json_decoder = json.JSONDecoder()
+# An escape sequence cut off at the end of a truncated string
+_PARTIAL_ESCAPE_RE = re.compile(r'(?<!\\)((?:\\\\)*)\\(?:u[0-9a-fA-F]{0,3})?$')
+
+
+def _load_checklist_json(text: str) -> Dict[str, Any]:
+    """Parse model output as checklist JSON, tolerating code fences, surrounding prose and truncation"""
+    cleaned_text = text.strip()
+    # Skip code fences or any preamble before the object
+    start = cleaned_text.find("{")
+    if start < 0:
+        raise json.JSONDecodeError("No JSON object in model output", cleaned_text, 0)
+    cleaned_text = cleaned_text[start:]
+    if cleaned_text.endswith("```"):
+        cleaned_text = cleaned_text[:-3].rstrip()
+
+    if cleaned_text.endswith("}"):
+        try:
+            # Well-formed output is the common case
+            return orjson.loads(cleaned_text)
+        except orjson.JSONDecodeError:
+            pass
+
+    try:
+        # Parses exactly one balanced object and ignores whatever follows it
+        data, _ = _json_decoder.raw_decode(cleaned_text)
+        return data
+    except json.JSONDecodeError:
+        pass
+
+    # Output was cut off (max tokens): close whatever is still open
+    return orjson.loads(_close_truncated_json(cleaned_text))
+
+
+def _close_truncated_json(text: str) -> str:
+    """
+    Close JSON that stops mid-document.
+
+    A cut inside a string value keeps the partial text. A cut inside a key, before
+    a value, or in a partial literal falls back to the last complete value.
+    """
+    closers: List[str] = []
+    expects_key: List[bool] = []  # Per open container: the next string is an object key
+    safe_end, safe_closers = 0, ""  # Last cut point that leaves valid JSON once closed
+    in_string = False
+    string_is_key = False
+    escaped = False
+    token_start = -1  # Start of a number/true/false/null still being read
+    for i, ch in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+                if not string_is_key:
+                    safe_end, safe_closers = i + 1, "".join(reversed(closers))
+            continue
+        if token_start >= 0 and (ch in ",}] \t\r\n"):
+            safe_end, safe_closers = i, "".join(reversed(closers))
+            token_start = -1
+        if ch == '"':
+            in_string = True
+            string_is_key = bool(expects_key) and expects_key[-1]
+            if string_is_key:
+                expects_key[-1] = False
+        elif ch in "{[":
+            closers.append("}" if ch == "{" else "]")
+            expects_key.append(ch == "{")
+            safe_end, safe_closers = i + 1, "".join(reversed(closers))
+        elif ch in "}]":
+            if closers:
+                closers.pop()
+                expects_key.pop()
+            safe_end, safe_closers = i + 1, "".join(reversed(closers))
+        elif ch == ",":
+            if closers and closers[-1] == "}":
+                expects_key[-1] = True
+        elif ch not in ": \t\r\n" and token_start < 0:
+            token_start = i
+
+    if in_string and not string_is_key:
+        # Keep the partial value, minus any escape sequence it stops inside
+        value = _PARTIAL_ESCAPE_RE.sub(r"\1", text)
+        return value + '"' + "".join(reversed(closers))
+    if token_start >= 0 and not in_string:
+        try:
+            orjson.loads(text[token_start:])
+            return text + "".join(reversed(closers))
+        except orjson.JSONDecodeError:
+            pass
+    return text[:safe_end] + safe_closers
+
+
+def _normalize_checklist_item(item: Any, idx: int) -> Optional[Dict[str, Any]]:
+    """Clean one raw checklist entry, or None if it has no meaningful step text"""
+    if isinstance(item, dict):
+        # Models sometimes emit null or non-numeric fields; keep the step rather than failing
+        try:
+            step_num = int(item.get("step", idx))
+        except (TypeError, ValueError):
+            step_num = idx
+        step_text = _clean_checklist_step(item.get("text") or "")
+        explanation = str(item.get("explanation") or "").strip()
+        citation = item.get("citation", 0)  # Get citation number
+    else:
+        step_num = idx
+        step_text = _clean_checklist_step(str(item))
+        explanation = ""
+        citation = 0
     
-    # Intent-specific templates (concise)
-    intent_hints = {
-        'emergency': "Start with immediate actions (call 911, etc.). Keep steps urgent and short.",
-        'symptoms': "List symptoms chronologically. Include severity levels and when to seek help.",
-        'treatment': "Start with first-line treatments. Include specific dosages/instructions.",
-        'diagnosis': "Clinical assessment → diagnostic tests → criteria. Be specific.",
-        'prevention': "Primary prevention first. Practical, actionable steps.",
-        'general': "Logical flow: assessment → intervention → follow-up. Stay concise."
+    if not step_text or len(step_text) <= 3:  # Only include meaningful steps
+        return None
+    return {
+        "step": step_num, 
+        "text": step_text,
+        "explanation": explanation,
+        "citation": citation if isinstance(citation, int) else 0
     }
+
+
+def _normalize_checklist(data: Dict[str, Any], title: str) -> Dict[str, Any]:
+    """Clean parsed model output into the title/checklist/citations shape"""
+    out_title = str(data.get("title", title)).strip() or title
+    raw_items = data.get("checklist", [])
+    checklist: List[Dict[str, Any]] = []
     
-    prompt_parts = base_instructions + [
-        "",
-        f"HINT: {intent_hints.get(intent, intent_hints['general'])}",
-        "",
-        "⛔ FILTERS:",
-        "- Skip sources about DIFFERENT conditions",
-        "- Only info DIRECTLY related to: {title}",
-        "- 3-4 accurate steps better than 10 with made-up content",
-    ]
+    for idx, item in enumerate(raw_items, start=1):
+        step = _normalize_checklist_item(item, idx)
+        if step is not None:
+            checklist.append(step)
     
-    prompt_parts.append("")
-    prompt_parts.append(f"━━━ QUERY: {title}")
-    if region:
-        prompt_parts.append(f"Region: {region}")
-    if year:
-        prompt_parts.append(f"Year: {year}")
-    if instructions:
-        prompt_parts.append(f"Note: {instructions}")
-    prompt_parts.append("")
-    prompt_parts.append("━━━ SOURCES (cite as [Source N]):")
+    citations = data.get("citations", [])
+    if not isinstance(citations, list):
+        citations = []
+    citations = [str(c).strip() for c in citations if str(c).strip()]
     
-    # Add sources
-    for i, snippet in enumerate(context_snippets[:6], 1):
-        prompt_parts.append(f"[Source {i}] {snippet}")
-        prompt_parts.append("")
+    return {
+        "title": out_title,
+        "checklist": checklist,
+        "citations": citations,
+    }
+
 
-    prompt = "\n".join(prompt_parts)
+def _fallback_checklist(title: str, context_snippets: List[str]) -> Dict[str, Any]:
+    """Fallback: create concise steps from context"""
+    fallback_steps = []
+    for i, snippet in enumerate(context_snippets[:6], start=1):
+        cleaned = _clean_checklist_step(snippet)
+        if cleaned and len(cleaned) > 3:
+            fallback_steps.append({"step": i, "text": cleaned, "explanation": "", "citation": 0})
     
-    import json
+    return {
+        "title": title,
+        "checklist": fallback_steps,
+        "citations": [],
+    }
+
+
+def _checklist_cache_key(title: str, context_snippets: List[str], instructions: str | None, region: str | None, year: int | None) -> tuple:
+    # Only the first 6 snippets reach the prompt, so the rest must not split the key.
+    # Titles differing only in case or spacing ("Dengue  treatment" / "dengue treatment")
+    # get the same checklist, so they share an entry without an embedding call.
+    normalized_title = " ".join(title.lower().split())
+    return (settings.GEMINI_MODEL, normalized_title, tuple(context_snippets[:6]), instructions, region, year)
+
+
+def _dot(a: List[float], b: List[float]) -> float:
+    # map/operator.mul keeps the multiply loop in C; ~2.5x faster than a generator over zip
+    return sum(map(operator.mul, a, b))
+
+
+def _embed_title(title: str) -> Optional[List[float]]:
+    """Unit-length embedding of a checklist title, or None if embedding failed"""
+    vector = generate_embedding(title, task_type="semantic_similarity")
+    if not vector:
+        return None
+    norm = math.sqrt(_dot(vector, vector))
+    return [v / norm for v in vector] if norm else None
+
+
+def _semantic_cache_lookup(sources_key: tuple, title: str) -> Tuple[Optional[Dict[str, Any]], Optional[List[float]]]:
+    """Return (hit, title vector); the vector is reused by the store on a miss"""
+    entries = _semantic_checklist_cache.get(sources_key)
+    if not entries:
+        # Nothing generated from these sources yet, so skip the embedding call
+        return None, None
+    query_vector = _embed_title(title)
+    if query_vector is None:
+        return None, None
+    best_score, best_result = max(
+        ((_dot(query_vector, vector), result) for vector, result in entries),
+        key=lambda entry: entry[0],
+    )
+    if best_score < _SEMANTIC_CACHE_THRESHOLD:
+        return None, query_vector
+    logger.info("♻️ Reusing checklist for similar title (similarity %.3f)", best_score)
+    hit = copy.deepcopy(best_result)
+    hit["title"] = title
+    return hit, query_vector
+
+
+def _semantic_cache_store(sources_key: tuple, title: str, result: Dict[str, Any], vector: Optional[List[float]] = None) -> None:
+    """Add result to the semantic cache; result must be a private copy"""
+    if vector is None:
+        vector = _embed_title(title)
+        if vector is None:
+            return
+    entries = _semantic_checklist_cache.get(sources_key) or []
+    entries = entries[-(_SEMANTIC_CACHE_PER_SOURCES - 1):] + [(vector, result)]
+    _semantic_checklist_cache.set(sources_key, entries)
+
+
+def _schedule_semantic_cache_store(sources_key: tuple, title: str, result: Dict[str, Any], vector: Optional[List[float]]) -> None:
+    # Embedding the title can take a network round-trip, so the store runs off the
+    # response path; the set keeps a reference until the task finishes
+    task = asyncio.create_task(
+        asyncio.to_thread(_semantic_cache_store, sources_key, title, copy.deepcopy(result), vector)
+    )
+    _semantic_store_tasks.add(task)
+    task.add_done_callback(_semantic_store_tasks.discard)
+
+
+# Appended to the prompt when the first reply is missing required fields
+_RETRY_REMINDER = (
+    "\n\n⚠️⚠️⚠️ CRITICAL: Previous response was incomplete. You MUST include:\n"
+    "1. 'explanation' field (2-3 sentences) for EVERY step\n"
+    "2. 'citation' field (1, 2, 3...) for EVERY step\n"
+    "3. 'citations' array with full source text\n"
+    "DO NOT leave these fields empty!\n"
+)
+
+
+async def summarize_checklist(title: str, context_snippets: List[str], instructions: str | None = None, region: str | None = None, year: int | None = None) -> Dict[str, Any]:
+    cache_key = _checklist_cache_key(title, context_snippets, instructions, region, year)
+    cached = _checklist_cache.get(cache_key)
+    if cached is not None:
+        return copy.deepcopy(cached)
+
+    sources_key = cache_key[:1] + cache_key[2:] + (classify_query_intent(title),)
+    similar, title_vector = await asyncio.to_thread(_semantic_cache_lookup, sources_key, title)
+    if similar is not None:
+        _checklist_cache.set(cache_key, copy.deepcopy(similar))
+        return similar
+
+    _ensure_client()
+    assert _model is not None
+
+    prompt = _build_checklist_prompt(title, context_snippets, instructions, region, year)
     
     # Retry up to 2 times for incomplete responses
     max_retries = 2
@@ -249,7 +567,7 @@ def summarize_checklist(title: str, context_snippets: List[str], instructions: s
     
     for attempt in range(max_retries):
         try:
-            response = _model.generate_content(prompt)
+            response = await _model.generate_content_async(prompt)
             text = _extract_text(response)
             
             if not text:
@@ -258,117 +576,174 @@ def summarize_checklist(title: str, context_snippets: List[str], instructions: s
             
             # Try to parse JSON, fixing common issues
             try:
-                # Remove markdown code blocks if present
-                cleaned_text = text.strip()
-                if cleaned_text.startswith("```json"):
-                    cleaned_text = cleaned_text[7:]
-                if cleaned_text.startswith("```"):
-                    cleaned_text = cleaned_text[3:]
-                if cleaned_text.endswith("```"):
-                    cleaned_text = cleaned_text[:-3]
-                cleaned_text = cleaned_text.strip()
-                
-                # Try to fix incomplete JSON by adding closing braces
-                if not cleaned_text.endswith("}"):
-                    # Count opening vs closing braces
-                    open_braces = cleaned_text.count("{")
-                    close_braces = cleaned_text.count("}")
-                    if open_braces > close_braces:
-                        # Add missing closing braces
-                        cleaned_text += "]}" * (open_braces - close_braces)
-                
-                data = json.loads(cleaned_text)
+                data = _load_checklist_json(text)
                 
                 # Validate the response quality
                 is_valid, validation_msg = _validate_protocol_response(data)
                 
                 if not is_valid:
                     last_error = f"Incomplete response: {validation_msg}"
-                    print(f"⚠️ Attempt {attempt + 1}/{max_retries}: {last_error}")
-                    print(f"📊 Protocol title: '{title}'")
-                    print(f"📊 Steps in response: {len(data.get('checklist', []))}")
-                    print(f"📊 Citations in response: {len(data.get('citations', []))}")
+                    logger.warning("⚠️ Attempt %d/%d: %s", attempt + 1, max_retries, last_error)
+                    logger.debug(
+                        "📊 Protocol title: %r, steps in response: %d, citations in response: %d",
+                        title, len(data.get('checklist', [])), len(data.get('citations', [])),
+                    )
                     
                     if attempt < max_retries - 1:
                         # Add stronger reminder to the prompt for retry
-                        prompt += "\n\n⚠️⚠️⚠️ CRITICAL: Previous response was incomplete. You MUST include:\n"
-                        prompt += "1. 'explanation' field (2-3 sentences) for EVERY step\n"
-                        prompt += "2. 'citation' field (1, 2, 3...) for EVERY step\n"
-                        prompt += "3. 'citations' array with full source text\n"
-                        prompt += "DO NOT leave these fields empty!\n"
-                        print(f"🔄 Retrying with enhanced prompt...")
+                        prompt += _RETRY_REMINDER
+                        logger.info("🔄 Retrying with enhanced prompt...")
                         continue
                     # On last attempt, accept but log warning
-                    print(f"⚠️ WARNING: Using incomplete response after {max_retries} attempts: {validation_msg}")
-                    print(f"⚠️ This is the issue reported by the user - protocol has empty explanations/citations")
+                    logger.warning("⚠️ Using incomplete response after %d attempts: %s", max_retries, validation_msg)
                 
-                # Parse and clean the data
-                out_title = str(data.get("title", title)).strip() or title
-                raw_items = data.get("checklist", [])
-                checklist: List[Dict[str, Any]] = []
-                
-                for idx, item in enumerate(raw_items, start=1):
-                    if isinstance(item, dict):
-                        step_num = int(item.get("step", idx))
-                        step_text = _clean_checklist_step(item.get("text", ""))
-                        explanation = item.get("explanation", "").strip()
-                        citation = item.get("citation", 0)  # Get citation number
-                    else:
-                        step_num = idx
-                        step_text = _clean_checklist_step(str(item))
-                        explanation = ""
-                        citation = 0
-                    
-                    if step_text and len(step_text) > 3:  # Only include meaningful steps
-                        checklist.append({
-                            "step": step_num, 
-                            "text": step_text,
-                            "explanation": explanation,
-                            "citation": citation if isinstance(citation, int) else 0
-                        })
+                result = _normalize_checklist(data, title)
                 
-                citations = data.get("citations", [])
-                if not isinstance(citations, list):
-                    citations = []
-                citations = [str(c).strip() for c in citations if str(c).strip()]
-                
-                result = {
-                    "title": out_title,
-                    "checklist": checklist,
-                    "citations": citations,
-                }
-                
-                print(f"✅ Successfully generated protocol (attempt {attempt + 1}/{max_retries})")
+                logger.info("✅ Successfully generated protocol (attempt %d/%d)", attempt + 1, max_retries)
+                # Incomplete and fallback checklists are not cached so the next request retries the model
+                if is_valid:
+                    _checklist_cache.set(cache_key, copy.deepcopy(result))
+                    _schedule_semantic_cache_store(sources_key, title, result, title_vector)
                 return result
                 
             except json.JSONDecodeError as e:
-                last_error = f"JSON parse error: {str(e)}"
-                print(f"⚠️ Attempt {attempt + 1}/{max_retries}: {last_error}")
+                last_error = f"JSON parse error: {e}"
+                logger.warning("⚠️ Attempt %d/%d: %s", attempt + 1, max_retries, last_error)
+                logger.debug("LLM response head=%r len=%d", text[:500], len(text))
                 if attempt < max_retries - 1:
                     continue
                 # Fall through to fallback
                 
         except Exception as e:
             last_error = str(e)
-            print(f"⚠️ Attempt {attempt + 1}/{max_retries} failed: {last_error}")
+            logger.warning("⚠️ Attempt %d/%d failed: %s", attempt + 1, max_retries, last_error)
             if attempt < max_retries - 1:
                 continue
             # Fall through to fallback
     
-    print(f"❌ All {max_retries} attempts failed. Last error: {last_error}. Using fallback.")
+    logger.error("❌ All %d attempts failed. Last error: %s. Using fallback.", max_retries, last_error)
+    return _fallback_checklist(title, context_snippets)
 
-    # Fallback: create concise steps from context
-    fallback_steps = []
-    for i, snippet in enumerate(context_snippets[:6], start=1):
-        cleaned = _clean_checklist_step(snippet)
-        if cleaned and len(cleaned) > 3:
-            fallback_steps.append({"step": i, "text": cleaned})
-    
-    return {
-        "title": title,
-        "checklist": fallback_steps,
-        "citations": [],
-    }
+
+_CHECKLIST_ARRAY_RE = re.compile(r'"checklist"\s*:\s*\[')
+_ITEM_SEPARATOR_RE = re.compile(r'[\s,]*')
+
+
+class _ChecklistStepScanner:
+    """Pulls complete checklist items out of a JSON document as it streams in"""
+
+    def __init__(self) -> None:
+        self.buffer = ""
+        self.pos = -1  # Next unread offset inside the checklist array, -1 until it is found
+        self.count = 0
+        self.done = False
+
+    def feed(self, text: str) -> List[tuple]:
+        """Add streamed text and return (index, item) for every newly completed item"""
+        self.buffer += text
+        if self.done:
+            return []
+        if self.pos < 0:
+            match = _CHECKLIST_ARRAY_RE.search(self.buffer)
+            if match is None:
+                return []
+            self.pos = match.end()
+
+        items = []
+        while True:
+            start = _ITEM_SEPARATOR_RE.match(self.buffer, self.pos).end()
+            if start >= len(self.buffer):
+                break
+            if self.buffer[start] == "]":
+                self.done = True
+                break
+            try:
+                item, end = _json_decoder.raw_decode(self.buffer, start)
+            except json.JSONDecodeError:
+                break  # Item is still incomplete; wait for more text
+            self.count += 1
+            items.append((self.count, item))
+            self.pos = end
+        return items
+
+
+async def stream_checklist(title: str, context_snippets: List[str], instructions: str | None = None, region: str | None = None, year: int | None = None) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Streaming variant of summarize_checklist.
+
+    Yields {"delta": text} as the model produces output and {"step": {...}} as
+    soon as each checklist item is complete, then a final {"result": {...}} with
+    the parsed checklist. There is no retry: the deltas have already been sent,
+    so an unusable response falls back immediately.
+    """
+    _ensure_client()
+    assert _model is not None
+
+    prompt = _build_checklist_prompt(title, context_snippets, instructions, region, year)
+    scanner = _ChecklistStepScanner()
+    try:
+        response = await _model.generate_content_async(prompt, stream=True)
+        async for chunk in response:
+            text = _extract_text(chunk)
+            if not text:
+                continue
+            yield {"delta": text}
+            for idx, item in scanner.feed(text):
+                step = _normalize_checklist_item(item, idx)
+                if step is not None:
+                    yield {"step": step}
+    except Exception as e:
+        logger.warning("⚠️ Streaming generation failed: %s", e)
+
+    result = None
+    if scanner.buffer:
+        try:
+            result = _normalize_checklist(_load_checklist_json(scanner.buffer), title)
+        except json.JSONDecodeError as e:
+            logger.warning("⚠️ Streamed response was not valid JSON: %s", e)
+        except Exception as e:
+            # The SSE headers are already sent, so anything escaping here would drop
+            # the stream without a result event
+            logger.warning("⚠️ Could not normalize streamed response: %s", e)
+    if result is None:
+        result = _fallback_checklist(title, context_snippets)
+    yield {"result": result}
+
+
+# Static parts of the step-thread prompt, kept out of the per-call f-string
+_STEP_THREAD_PROMPT_HEAD = """You are a medical AI assistant. Answer questions about THIS SPECIFIC STEP ONLY.
+
+⚠️ CRITICAL RULES:
+1. Use ONLY the information in the SOURCE below
+2. DO NOT add information from your general knowledge
+3. Stay focused on THIS step - don't discuss other parts of the protocol
+4. If the SOURCE doesn't answer the question, say so clearly
+
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+"""
+_STEP_THREAD_PROMPT_TAIL = """6. **Formatting**:
+   - Use **bold** for medical terms
+   - Use bullet points for lists
+   - Keep paragraphs concise (2-3 sentences)
+
+EXAMPLE RESPONSE (if SOURCE has the info):
+"**Direct Answer:** [Extract from SOURCE].
+
+**Clinical Rationale:** [Why - from SOURCE].
+
+**Practical Considerations:**
+- Timing: [from SOURCE]
+- Technique: [from SOURCE]
+- Monitoring: [from SOURCE]
+
+**Note:** [Warnings from SOURCE, if any]."
+
+EXAMPLE RESPONSE (if SOURCE lacks info):
+"The available source for this step doesn't provide specific information about [aspect of question]. For detailed guidance on [topic], please consult the full medical guidelines or ask in the main protocol chat."
+
+⚠️ Remember: ONLY use information from the SOURCE above. Do NOT add external medical knowledge."
+
+Now provide a clear, well-formatted, helpful response:"""
 
 
 def step_thread_chat(
@@ -402,16 +777,7 @@ def step_thread_chat(
             for msg in thread_history[-5:]  # Last 5 messages
         ])
     
-    prompt = f"""You are a medical AI assistant. Answer questions about THIS SPECIFIC STEP ONLY.
-
-⚠️ CRITICAL RULES:
-1. Use ONLY the information in the SOURCE below
-2. DO NOT add information from your general knowledge
-3. Stay focused on THIS step - don't discuss other parts of the protocol
-4. If the SOURCE doesn't answer the question, say so clearly
-
-━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
-📋 PROTOCOL: {protocol_title}
+    prompt = f"""{_STEP_THREAD_PROMPT_HEAD}📋 PROTOCOL: {protocol_title}
 📍 STEP {step_id}: {step_text}
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
@@ -437,29 +803,7 @@ RESPONSE REQUIREMENTS:
    
 4. **Citations**: Reference the source when applicable
 5. **Scope**: If question is beyond this step, say: "This question is broader than Step {step_id}. Please ask in the main chat."
-6. **Formatting**:
-   - Use **bold** for medical terms
-   - Use bullet points for lists
-   - Keep paragraphs concise (2-3 sentences)
-
-EXAMPLE RESPONSE (if SOURCE has the info):
-"**Direct Answer:** [Extract from SOURCE].
-
-**Clinical Rationale:** [Why - from SOURCE].
-
-**Practical Considerations:**
-- Timing: [from SOURCE]
-- Technique: [from SOURCE]
-- Monitoring: [from SOURCE]
-
-**Note:** [Warnings from SOURCE, if any]."
-
-EXAMPLE RESPONSE (if SOURCE lacks info):
-"The available source for this step doesn't provide specific information about [aspect of question]. For detailed guidance on [topic], please consult the full medical guidelines or ask in the main protocol chat."
-
-⚠️ Remember: ONLY use information from the SOURCE above. Do NOT add external medical knowledge."
-
-Now provide a clear, well-formatted, helpful response:"""
+{_STEP_THREAD_PROMPT_TAIL}"""
 
     try:
         response = _model.generate_content(prompt)
@@ -476,50 +820,24 @@ Now provide a clear, well-formatted, helpful response:"""
         }
 
 
-def _analyze_question_type(message: str, protocol_title: str) -> Dict[str, Any]:
-    """
-    Analyze the user's question to determine intent and category.
-    Returns structured information about the question.
-    """
-    message_lower = message.lower()
-    
-    # Question categories with keywords
-    categories = {
-        'dosage': ['dosage', 'dose', 'how much', 'amount', 'mg', 'ml', 'quantity'],
-        'symptoms': ['symptom', 'sign', 'feel', 'looks like', 'presentation', 'manifest'],
-        'timing': ['when', 'how long', 'duration', 'frequency', 'how often', 'timing'],
-        'complications': ['complication', 'risk', 'side effect', 'adverse', 'danger', 'problem'],
-        'safety': ['safe', 'avoid', 'caution', 'warning', 'contraindication', 'dangerous'],
-        'procedure': ['how to', 'procedure', 'steps', 'technique', 'method', 'perform'],
-        'comparison': ['compare', 'difference', 'versus', 'vs', 'alternative', 'instead'],
-        'rationale': ['why', 'reason', 'because', 'explain', 'rationale', 'purpose']
-    }
-    
-    detected_categories = []
-    for category, keywords in categories.items():
-        if any(keyword in message_lower for keyword in keywords):
-            detected_categories.append(category)
-    
-    # Check if question is about the same topic
-    protocol_words = set(protocol_title.lower().split())
-    message_words = set(message_lower.split())
-    topic_overlap = len(protocol_words & message_words) / len(protocol_words) if protocol_words else 0
-    
-    # Special cases for follow-up questions
-    is_clarification = any(word in message_lower for word in [
-        'differentiate', 'explain', 'clarify', 'detail', 'specific', 'more about',
-        'tell me', 'what about', 'how do', 'mild', 'severe', 'compare'
-    ])
-    
-    # Very permissive for follow-ups: assume related unless obviously different disease
-    is_related = topic_overlap > 0.2 or len(message) < 120 or is_clarification or detected_categories
-    
-    return {
-        'categories': detected_categories,
-        'primary_category': detected_categories[0] if detected_categories else 'general',
-        'is_related_topic': is_related,
-        'topic_overlap': topic_overlap
-    }
+# Keywords marking comparison questions, matched as one alternation
+_COMPARISON_KEYWORDS = ('differentiate', 'difference', 'compare', 'vs', 'versus', 'between')
+_COMPARISON_RE = re.compile('|'.join(_COMPARISON_KEYWORDS))
+# Static reply-format instructions closing the protocol chat prompt
+_CHAT_PROMPT_TAIL = """ Use **bold** for key medical terms. Cite sources as [N].
+
+**Answer:**
+<your answer>
+
+**Follow-up questions:**
+- <question 1>
+- <question 2>
+- <question 3>"""
+# Only these fields feed the follow-up context, so ES skips sending the rest of
+# each document (full content, metadata) that would just be discarded here
+_CONTEXT_SEARCH_SOURCE = {"includes": ["title", "body", "organization", "source_url"]}
+_PUNCTUATION_RE = re.compile(r'[^\w\s]')
+_TITLE_STOPWORDS = frozenset({'what', 'are', 'the', 'of', 'for', 'how', 'to', 'is', 'a', 'an', 'do', 'i'})
 
 
 def _generate_smart_followups(message: str, protocol_title: str, conversation_history: List[Dict[str, str]], question_analysis: Dict[str, Any]) -> List[str]:
@@ -634,6 +952,12 @@ def protocol_conversation_chat(
         Dict with answer, citations, sources, follow-up questions
     """
     _ensure_client()
+
+    # Lowercased once; reused by the context search, question analysis and prompt hints
+    message_lower = message.lower()
+    # Detect if this is a comparison question (mild vs severe, etc.); drives both
+    # the context search query and the answer format ('mild vs severe' is covered by 'vs')
+    is_comparison_question = _COMPARISON_RE.search(message_lower) is not None
     
     # Fresh context search for long conversations
     additional_sources = []
@@ -644,28 +968,22 @@ def protocol_conversation_chat(
     
     if enable_context_search:
         try:
-            from services.elasticsearch_service import hybrid_search
-            
             # FULL HYBRID SEARCH for follow-up question
             # Strategy: ALWAYS combine protocol context + follow-up question
             # This ensures we get specific info while maintaining topical relevance
             
             # Extract key terms from protocol title (remove common words and punctuation)
-            import re
             # Remove punctuation first, then split
-            cleaned_title = re.sub(r'[^\w\s]', ' ', concept_title.lower())  # Replace with space, not empty
+            cleaned_title = _PUNCTUATION_RE.sub(' ', concept_title.lower())  # Replace with space, not empty
             protocol_keywords = ' '.join([
                 word for word in cleaned_title.split() 
-                if word and word not in ['what', 'are', 'the', 'of', 'for', 'how', 'to', 'is', 'a', 'an', 'do', 'i']
+                if word and word not in _TITLE_STOPWORDS
             ]).strip()
             
             print(f"🔧 Cleaned title: '{concept_title}' → '{cleaned_title}' → keywords: '{protocol_keywords}'")
             
-            # ENHANCED: Detect comparison/differentiation questions and expand query
-            message_lower = message.lower()
-            is_comparison = any(keyword in message_lower for keyword in [
-                'differentiate', 'difference', 'compare', 'vs', 'versus', 'between'
-            ])
+            # ENHANCED: Comparison/differentiation questions expand the query
+            is_comparison = is_comparison_question
             
             # Check if it's specifically about mild vs severe
             is_mild_severe = ('mild' in message_lower and 'severe' in message_lower)
@@ -692,25 +1010,28 @@ def protocol_conversation_chat(
             search_result = hybrid_search(
                 query=search_query,
                 size=8,  # Get more results for better coverage
-                filters=filters_json or {}
+                filters=filters_json or {},
+                source=_CONTEXT_SEARCH_SOURCE
             )
             
             if search_result and not search_result.get("error"):
                 hits = search_result.get("hits", {}).get("hits", [])
                 print(f"📊 Hybrid search returned {len(hits)} results")
                 
+                top_hits = hits[:6]  # Take top 6
+                scores = [hit.get("_score", 0) for hit in top_hits]
+                
                 # Normalize scores to 0-1 range based on max score
-                max_score = max([hit.get("_score", 0) for hit in hits[:6]], default=1.0)
+                max_score = max(scores, default=1.0)
                 if max_score == 0:
                     max_score = 1.0
                 
-                for idx, hit in enumerate(hits[:6], start=len(citations_list) + 1):  # Take top 6
+                for idx, (hit, score) in enumerate(zip(top_hits, scores), start=len(citations_list) + 1):
                     source = hit.get("_source", {})
                     title = source.get("title", "")
                     body = source.get("body", "")
                     organization = source.get("organization", "")
                     url = source.get("source_url", "")
-                    score = hit.get("_score", 0)
                     
                     # Normalize score to 0-1 range
                     normalized_score = score / max_score
@@ -732,25 +1053,20 @@ def protocol_conversation_chat(
                 if additional_sources:
                     used_new_sources = True
                     print(f"✅ Found {len(additional_sources)} additional sources via HYBRID search")
-                    print(f"🎯 Top result: {hits[0].get('_source', {}).get('title', 'N/A')[:60]}...")
-                    # Show all new source titles for debugging
-                    for idx, hit in enumerate(hits[:6], 1):
-                        title = hit.get('_source', {}).get('title', 'N/A')
-                        print(f"   [{idx}] {title}")
+                    print(f"🎯 Top result: {(additional_citations[0]['title'] or 'N/A')[:60]}...")
+                    # Show all new source titles for debugging (already pulled out of the hits above)
+                    for idx, citation_obj in enumerate(additional_citations, 1):
+                        print(f"   [{idx}] {citation_obj['title'] or 'N/A'}")
             else:
                 print(f"⚠️ No results from hybrid search")
         except Exception as e:
             print(f"⚠️ Hybrid search failed: {e}")
-            import traceback
             traceback.print_exc()
             # Continue without additional sources
     
     if conversation_history is None:
         conversation_history = []
     
-    # Analyze the question to understand intent
-    question_analysis = _analyze_question_type(message, concept_title)
-    
     # Build conversation history
     history_text = ""
     if conversation_history:
@@ -762,86 +1078,37 @@ def protocol_conversation_chat(
     # Combine all sources FIRST (before using in prompt)
     all_sources = citations_list + additional_sources if used_new_sources else citations_list
     
-    # Format protocol data
-    protocol_text = f"Title: {protocol_json.get('title', concept_title)}\n"
-    if 'checklist' in protocol_json:
-        protocol_text += "Steps:\n"
-        for step in protocol_json['checklist'][:10]:  # Limit to 10 steps
-            step_num = step.get('step', 0)
-            step_text = step.get('text', '')
-            explanation = step.get('explanation', '')
-            citation = step.get('citation', 0)
-            protocol_text += f"{step_num}. {step_text}"
-            if explanation:
-                protocol_text += f" - {explanation[:100]}..."
-            if citation:
-                protocol_text += f" [Source {citation}]"
-            protocol_text += "\n"
-    
     # Format citations - PRIORITIZE new search results for follow-up questions
-    citations_text = ""
-    
     if used_new_sources and additional_sources:
         # Show NEW sources FIRST and in FULL (for follow-up questions)
         # Map to actual citation IDs from additional_citations
-        citations_text = "\n━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
-        citations_text += "🆕 NEW SOURCES (From fresh search - USE THESE FIRST):\n"
-        citations_text += "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
+        citation_parts = [
+            "\n━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
+            "🆕 NEW SOURCES (From fresh search - USE THESE FIRST):\n"
+            "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
+        ]
         for idx, citation_obj in enumerate(additional_citations):
             citation_id = citation_obj.get('id', idx + 1)
             title = citation_obj.get('title', 'Unknown')
             excerpt = citation_obj.get('excerpt', '')
             # Show with actual citation ID
-            citations_text += f"\n[{citation_id}] {title}\n{excerpt}\n"
+            citation_parts.append(f"\n[{citation_id}] {title}\n{excerpt}\n")
         
         # Then show original sources as reference (if any)
         if citations_list:
-            citations_text += "\n━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
-            citations_text += "📚 ORIGINAL PROTOCOL SOURCES (Background context):\n"
-            citations_text += "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
+            citation_parts.append(
+                "\n━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
+                "📚 ORIGINAL PROTOCOL SOURCES (Background context):\n"
+                "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
+            )
             for i, citation in enumerate(citations_list[:3], 1):
-                citations_text += f"[Original {i}] {citation[:150]}...\n"
+                citation_parts.append(f"[Original {i}] {citation[:150]}...\n")
     else:
         # No new sources - just show original
-        citations_text = "\nAvailable Sources:\n"
+        citation_parts = ["\nAvailable Sources:\n"]
         for i, citation in enumerate(citations_list[:8], 1):
-            citations_text += f"[Source {i}] {citation[:250]}...\n"
-    
-    # Format filters if any
-    filters_text = ""
-    if filters_json:
-        filters_text = f"\nUser Filters: {filters_json}"
-
-    # Enhanced prompt with question categorization
-    question_category = question_analysis['primary_category']
-    is_related = question_analysis['is_related_topic']
-    
-    # Add category-specific guidance
-    category_guidance = {
-        'dosage': 'Focus on specific dosage recommendations, adjustments based on patient factors, and administration guidelines.',
-        'symptoms': 'Describe symptom progression, severity indicators, and how to differentiate from similar conditions.',
-        'timing': 'Provide clear timelines, frequency schedules, and duration expectations.',
-        'complications': 'Explain risk factors, early warning signs, and prevention strategies.',
-        'safety': 'Emphasize contraindications, warning signs, and when to seek help.',
-        'procedure': 'Give step-by-step instructions, required materials, and technique tips.',
-        'comparison': 'Compare approaches objectively with evidence-based pros and cons. Use side-by-side comparison format.',
-        'rationale': 'Explain the medical reasoning, evidence basis, and clinical decision factors.'
-    }
-    
-    # Detect if this is a comparison question (mild vs severe, etc.)
-    is_comparison_question = any(keyword in message.lower() for keyword in [
-        'differentiate', 'difference', 'compare', 'vs', 'versus', 'between', 'mild vs severe'
-    ])
-    
-    category_hint = category_guidance.get(question_category, 'Provide comprehensive, evidence-based information.')
-    
-    # Add special instructions for comparison questions
-    if is_comparison_question:
-        category_hint += "\n\n⚠️ COMPARISON FORMAT REQUIRED:\n"
-        category_hint += "Structure your answer as:\n"
-        category_hint += "**Mild/Early Stage:** [describe from sources] [Source N]\n"
-        category_hint += "**Severe/Advanced Stage:** [describe from sources] [Source N]\n"
-        category_hint += "**Key Differences:** [highlight distinguishing factors] [Source N]"
+            citation_parts.append(f"[Source {i}] {citation[:250]}...\n")
+    citations_text = "".join(citation_parts)
     
     # Simple prompt - lists for everything except tables
     if is_comparison_question:
@@ -855,15 +1122,7 @@ Available sources:
 {citations_text}
 
 {f"Previous conversation:{chr(10)}{history_text}{chr(10)}" if history_text else ""}
-Answer using information from the sources above. {format_instruction} Use **bold** for key medical terms. Cite sources as [N].
-
-**Answer:**
-<your answer>
-
-**Follow-up questions:**
-- <question 1>
-- <question 2>
-- <question 3>"""
+Answer using information from the sources above. {format_instruction}{_CHAT_PROMPT_TAIL}"""
 
     # Debug logging
     print(f"📝 Prompt: {len(prompt)} chars, {len(all_sources)} sources")
@@ -888,11 +1147,13 @@ Answer using information from the sources above. {format_instruction} Use **bold
         
     except Exception as e:
         print(f"❌ Exception in protocol_conversation_chat: {e}")
-        import traceback
         traceback.print_exc()
         return _fallback_conversation_response(message, concept_title)
 
 
+_CITATION_MARKER_RE = re.compile(r'\[(\d+)\]')
+
+
 def _format_response_with_markdown(raw_response: str, question: str, is_comparison: bool) -> str:
     """
     Format AI response with proper markdown structure using a second AI call.
@@ -903,9 +1164,7 @@ def _format_response_with_markdown(raw_response: str, question: str, is_comparis
     question_lower = question.lower()
     
     # Detect question type
-    is_comparison_question = is_comparison or any(keyword in question_lower for keyword in [
-        'differentiate', 'difference', 'compare', 'vs', 'versus', 'between'
-    ])
+    is_comparison_question = is_comparison or _COMPARISON_RE.search(question_lower) is not None
     is_list_question = any(keyword in question_lower for keyword in [
         'what are', 'list', 'types', 'kinds', 'categories', 'warning signs', 'symptoms'
     ])
@@ -1010,9 +1269,8 @@ FORMATTED RESPONSE:"""
         print(f"📥 Received formatted response (length: {len(formatted_text)} chars)")
         
         # Verify citations weren't lost
-        import re
-        original_citations = set(re.findall(r'\[(\d+)\]', raw_response))
-        formatted_citations = set(re.findall(r'\[(\d+)\]', formatted_text))
+        original_citations = set(_CITATION_MARKER_RE.findall(raw_response))
+        formatted_citations = set(_CITATION_MARKER_RE.findall(formatted_text))
         
         if len(formatted_citations) < len(original_citations) * 0.8:  # Lost more than 20% of citations
             print(f"⚠️ Formatting lost citations ({len(formatted_citations)}/{len(original_citations)}) - using original")
@@ -1024,11 +1282,16 @@ FORMATTED RESPONSE:"""
         
     except Exception as e:
         print(f"⚠️ Formatting failed: {e} - using original response")
-        import traceback
         traceback.print_exc()
         return raw_response
 
 
+# Any line opening with "Answer:" or "**Answer" marks the structured reply format
+_RESPONSE_ANSWER_HEADER_RE = re.compile(r'^\s*(?:answer:|\*\*answer)', re.IGNORECASE | re.MULTILINE)
+_MULTI_SPACE_RE = re.compile(r' +')
+_EXTRA_BLANK_LINES_RE = re.compile(r'\n\n+')
+
+
 def _parse_conversation_response(response_text: str, citations_list: List[str]) -> Dict[str, Any]:
     """Parse the structured conversation response from Gemini"""
     response_text = response_text.strip()
@@ -1057,7 +1320,7 @@ def _parse_conversation_response(response_text: str, citations_list: List[str])
     has_structured_format = False
     
     # Check if response has structured format
-    if any(line.strip().lower().startswith(("answer:", "**answer")) for line in lines):
+    if _RESPONSE_ANSWER_HEADER_RE.search(response_text):
         has_structured_format = True
     
     # If no structured format, try to extract answer and follow-ups directly
@@ -1090,8 +1353,9 @@ def _parse_conversation_response(response_text: str, citations_list: List[str])
             if not line:
                 continue
             
+            line_lower = line.lower()
             # Flexible matching - handle both "Answer:" and "**Answer:**"
-            if line.lower().startswith("answer:") or line.lower().startswith("**answer"):
+            if line_lower.startswith(("answer:", "**answer")):
                 current_section = "answer"
                 # If answer is on the same line, extract it
                 if ":" in line:
@@ -1099,13 +1363,13 @@ def _parse_conversation_response(response_text: str, citations_list: List[str])
                     if answer_part and not answer_part.startswith("*"):
                         answer = answer_part + " "
                 continue
-            elif line.lower().startswith("uncertainty") or line.lower().startswith("**uncertainty"):
+            elif line_lower.startswith(("uncertainty", "**uncertainty")):
                 current_section = "uncertainty"
                 continue
-            elif line.lower().startswith("sources:") or line.lower().startswith("**sources"):
+            elif line_lower.startswith(("sources:", "**sources")):
                 current_section = "sources"
                 continue
-            elif "follow-up" in line.lower() and ("question" in line.lower() or "suggested" in line.lower()):
+            elif "follow-up" in line_lower and ("question" in line_lower or "suggested" in line_lower):
                 # Matches: "Follow-up questions:", "**Follow-up questions:**", "Suggested follow-ups:"
                 current_section = "follow_ups"
                 continue
@@ -1147,10 +1411,9 @@ def _parse_conversation_response(response_text: str, citations_list: List[str])
     parsed_answer = answer.strip()
     if parsed_answer:
         # Replace multiple spaces with single space
-        import re
-        parsed_answer = re.sub(r' +', ' ', parsed_answer)
+        parsed_answer = _MULTI_SPACE_RE.sub(' ', parsed_answer)
         # Clean up line breaks
-        parsed_answer = re.sub(r'\n\n+', '\n\n', parsed_answer)  # Max 2 line breaks
+        parsed_answer = _EXTRA_BLANK_LINES_RE.sub('\n\n', parsed_answer)  # Max 2 line breaks
         parsed_answer = parsed_answer.strip()
     else:
         parsed_answer = "I can help you with questions about this protocol."
@@ -1171,22 +1434,35 @@ def _parse_conversation_response(response_text: str, citations_list: List[str])
     }
 
 
+# Checked in order, like _QUERY_INTENT_RES; a single alternation would pick
+# whichever keyword appears first in the text instead
+_FOLLOW_UP_CATEGORY_KEYWORDS = (
+    ('dosage', ('dose', 'dosage', 'mg', 'ml', 'medication', 'drug')),
+    ('symptoms', ('symptom', 'sign', 'mild', 'severe', 'presentation')),
+    ('complications', ('complication', 'risk', 'side effect', 'adverse')),
+    ('timing', ('when', 'timing', 'how long', 'duration')),
+    ('safety', ('contraindication', 'avoid', 'caution', 'warning')),
+)
+_FOLLOW_UP_CATEGORY_RES = tuple(
+    (category, re.compile('|'.join(keywords))) for category, keywords in _FOLLOW_UP_CATEGORY_KEYWORDS
+)
+
+
 def _categorize_follow_up(question_text: str) -> str:
     """Categorize follow-up questions for better UX"""
     text_lower = question_text.lower()
-    
-    if any(word in text_lower for word in ['dose', 'dosage', 'mg', 'ml', 'medication', 'drug']):
-        return "dosage"
-    elif any(word in text_lower for word in ['symptom', 'sign', 'mild', 'severe', 'presentation']):
-        return "symptoms"
-    elif any(word in text_lower for word in ['complication', 'risk', 'side effect', 'adverse']):
-        return "complications"
-    elif any(word in text_lower for word in ['when', 'timing', 'how long', 'duration']):
-        return "timing"
-    elif any(word in text_lower for word in ['contraindication', 'avoid', 'caution', 'warning']):
-        return "safety"
-    else:
-        return "general"
+    for category, pattern in _FOLLOW_UP_CATEGORY_RES:
+        if pattern.search(text_lower):
+            return category
+    return "general"
+
+
+# Same suggestions for every fallback; callers only read them
+_FALLBACK_FOLLOW_UPS = (
+    {"text": "What are the key symptoms to monitor?", "category": "symptoms"},
+    {"text": "What are the recommended dosages?", "category": "dosage"},
+    {"text": "When should I seek immediate medical attention?", "category": "safety"},
+)
 
 
 def _fallback_conversation_response(message: str, concept_title: str) -> Dict[str, Any]:
@@ -1196,10 +1472,6 @@ def _fallback_conversation_response(message: str, concept_title: str) -> Dict[st
         "uncertainty_note": None,
         "sources": [],
         "used_new_sources": False,
-        "follow_up_questions": [
-            {"text": "What are the key symptoms to monitor?", "category": "symptoms"},
-            {"text": "What are the recommended dosages?", "category": "dosage"},
-            {"text": "When should I seek immediate medical attention?", "category": "safety"}
-        ],
+        "follow_up_questions": list(_FALLBACK_FOLLOW_UPS),
         "updated_protocol": None
     }
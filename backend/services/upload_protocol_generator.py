@@ -6,12 +6,22 @@ Isolated from the main gemini_service to avoid conflicts with other features
 
 from typing import List, Dict, Any, Optional
 import json
+import orjson
 import google.generativeai as genai
 from config.settings import settings
 
 _client_initialized = False
 _model: Any | None = None
 
+# Appended to a fresh copy of the prompt when a reply is missing required fields
+_RETRY_REMINDER = (
+    "\n\n⚠️⚠️⚠️ CRITICAL: Previous response was incomplete. You MUST include:\n"
+    "1. 'explanation' field (2-3 sentences) for EVERY step\n"
+    "2. 'citation' field (must be 1) for EVERY step\n"
+    "3. 'citations' array with source text\n"
+    "DO NOT leave these fields empty!\n"
+)
+
 
 def _ensure_client():
     """Initialize Gemini client if not already initialized"""
@@ -187,11 +197,7 @@ def generate_protocol_from_chunk(
                 current_prompt = base_prompt
             else:
                 # For retry, create FRESH enhanced prompt (don't mutate base_prompt)
-                current_prompt = base_prompt + "\n\n⚠️⚠️⚠️ CRITICAL: Previous response was incomplete. You MUST include:\n"
-                current_prompt += "1. 'explanation' field (2-3 sentences) for EVERY step\n"
-                current_prompt += "2. 'citation' field (must be 1) for EVERY step\n"
-                current_prompt += "3. 'citations' array with source text\n"
-                current_prompt += "DO NOT leave these fields empty!\n"
+                current_prompt = base_prompt + _RETRY_REMINDER
 
             response = _model.generate_content(current_prompt)
             text = _extract_text(response)
@@ -219,7 +225,7 @@ def generate_protocol_from_chunk(
                     if open_braces > close_braces:
                         cleaned_text += "]}" * (open_braces - close_braces)
 
-                data = json.loads(cleaned_text)
+                data = orjson.loads(cleaned_text)
 
                 # Validate response
                 is_valid, validation_msg = _validate_protocol_response(data)
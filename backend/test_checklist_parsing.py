@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Tests for checklist JSON parsing: repair of fenced, wrapped and truncated model
+output, and incremental step extraction from a streamed response
+"""
+
+import json
+from services.gemini_service import _load_checklist_json, _ChecklistStepScanner
+
+SAMPLE_CHECKLIST = {
+    "title": "Dengue Fever Management",
+    "checklist": [
+        {"step": 1, "text": "Give oral fluids", "explanation": "Prevents dehydration.", "citation": 1},
+        {"step": 2, "text": "Check platelets [daily]", "explanation": "Watch for a drop below 100k.", "citation": 2},
+    ],
+    "citations": ["WHO Dengue Guidelines", "CDC Dengue Treatment"],
+}
+SAMPLE_JSON = json.dumps(SAMPLE_CHECKLIST)
+# Cut inside the second checklist item
+TRUNCATED_PREFIX = SAMPLE_JSON[:SAMPLE_JSON.index('{"step": 2')]
+
+
+def test_fenced_output():
+    assert _load_checklist_json(f"```json\n{SAMPLE_JSON}\n```") == SAMPLE_CHECKLIST
+    assert _load_checklist_json(f"```\n{SAMPLE_JSON}\n```") == SAMPLE_CHECKLIST
+
+
+def test_prose_around_json():
+    text = f"Here is the protocol checklist:\n\n{SAMPLE_JSON}\n\nLet me know if you need more detail."
+    assert _load_checklist_json(text) == SAMPLE_CHECKLIST
+
+
+def test_truncated_mid_string():
+    data = _load_checklist_json(TRUNCATED_PREFIX + '{"step": 2, "text": "Check plate')
+    assert data["checklist"][-1] == {"step": 2, "text": "Check plate"}
+
+
+def test_truncated_mid_key():
+    data = _load_checklist_json(TRUNCATED_PREFIX + '{"step": 2, "expla')
+    assert data["checklist"][-1] == {"step": 2}
+
+    data = _load_checklist_json(TRUNCATED_PREFIX + '{"step": 2, "text": ')
+    assert data["checklist"][-1] == {"step": 2}
+
+
+def test_truncated_after_trailing_comma():
+    data = _load_checklist_json(TRUNCATED_PREFIX)
+    assert data["checklist"] == SAMPLE_CHECKLIST["checklist"][:1]
+
+    data = _load_checklist_json(SAMPLE_JSON[:SAMPLE_JSON.index('"CDC')])
+    assert data["citations"] == ["WHO Dengue Guidelines"]
+
+
+def test_every_truncation_parses():
+    for cut in range(1, len(SAMPLE_JSON)):
+        assert isinstance(_load_checklist_json(SAMPLE_JSON[:cut]), dict)
+
+
+def test_stream_split_inside_string_with_bracket():
+    scanner = _ChecklistStepScanner()
+    # The first chunk ends inside "Check platelets [daily]", right after its "]"
+    split = SAMPLE_JSON.index("[daily]") + len("[daily]")
+
+    first = scanner.feed(SAMPLE_JSON[:split])
+    assert first == [(1, SAMPLE_CHECKLIST["checklist"][0])]
+    assert not scanner.done
+
+    second = scanner.feed(SAMPLE_JSON[split:])
+    assert second == [(2, SAMPLE_CHECKLIST["checklist"][1])]
+    assert scanner.done
+
+
+def test_stream_one_character_at_a_time():
+    scanner = _ChecklistStepScanner()
+    items = []
+    for ch in SAMPLE_JSON:
+        items.extend(scanner.feed(ch))
+    assert items == list(enumerate(SAMPLE_CHECKLIST["checklist"], start=1))
+    assert scanner.done
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print(f"✅ {name}")